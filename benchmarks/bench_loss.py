@@ -0,0 +1,125 @@
+"""
+Compares the STORN variational loss against its former formulation, which added the
+log(2 pi) and -0.5 constants to every component and squared numerator and denominator
+separately.
+
+Every formulation is evaluated in its own subprocess, so the growth of its peak memory
+during the evaluation measures the intermediate tensors of the loss alone.
+
+Usage: python -m benchmarks.bench_loss --latent-dim 7,64,256
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+
+def former_variational_func(x_dim, latent_dim):
+    import keras.backend as K
+
+    def keras_variational(x, output_statistics):
+        x_stripped = x[:, :, :x_dim]
+        gen_mu, gen_sigma = output_statistics[:, :, :x_dim], output_statistics[:, :, x_dim:2 * x_dim]
+        encoder_mu = output_statistics[:, :, 2 * x_dim:2 * x_dim + latent_dim]
+        encoder_sigma = output_statistics[:, :, 2 * x_dim + latent_dim:2 * x_dim + 2 * latent_dim]
+        prior_mu = output_statistics[:, :, 2 * x_dim + 2 * latent_dim: 2 * x_dim + 3 * latent_dim]
+        prior_sigma = output_statistics[:, :, 2 * x_dim + 3 * latent_dim:]
+
+        expect_term = 0.5 * K.sum(K.square(x_stripped - gen_mu) / K.square(gen_sigma) + 2 * K.log(gen_sigma) +
+                                  K.log(2 * np.pi), axis=-1)
+        kl_term = K.sum(K.log(prior_sigma / encoder_sigma) +
+                        ((K.square(encoder_sigma) + K.square(encoder_mu - prior_mu)) / (2 * K.square(prior_sigma))) -
+                        0.5, axis=-1)
+        return kl_term + expect_term
+
+    return keras_variational
+
+
+def make_data(x_dim, latent_dim, n_sequences, seq_len):
+    rng = np.random.RandomState(0)
+    x = rng.randn(n_sequences, seq_len, x_dim).astype("float32")
+    stats = rng.randn(n_sequences, seq_len, 2 * x_dim + 4 * latent_dim).astype("float32")
+    # All sigmas positive
+    stats[:, :, x_dim:2 * x_dim] = np.abs(stats[:, :, x_dim:2 * x_dim]) + 0.1
+    stats[:, :, 2 * x_dim + latent_dim:2 * x_dim + 2 * latent_dim] = \
+        np.abs(stats[:, :, 2 * x_dim + latent_dim:2 * x_dim + 2 * latent_dim]) + 0.1
+    stats[:, :, 2 * x_dim + 3 * latent_dim:] = np.abs(stats[:, :, 2 * x_dim + 3 * latent_dim:]) + 0.1
+    return x, stats
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and is the peak of the whole process so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_job(job):
+    """
+    Evaluates one formulation and saves its loss to job["output"].
+    """
+    import keras.backend as K
+    from greenarm.models.loss.variational import keras_variational_func
+
+    x_dim, latent_dim = job["x_dim"], job["latent_dim"]
+    x, stats = make_data(x_dim, latent_dim, job["n_sequences"], job["seq_len"])
+    loss_func = former_variational_func(x_dim, latent_dim) if job["name"] == "former" \
+        else keras_variational_func(x_dim, latent_dim)
+
+    x_in = K.placeholder(ndim=3, dtype="float32")
+    stats_in = K.placeholder(ndim=3, dtype="float32")
+    function = K.function([x_in, stats_in], [loss_func(x_in, stats_in)])
+
+    baseline_mb = peak_rss_mb()
+    np.save(job["output"], function([x, stats])[0])
+    seconds = min(timeit.repeat(lambda: function([x, stats]), number=1, repeat=job["repeat"]))
+    return {"s": seconds, "peak_growth_mb": peak_rss_mb() - baseline_mb}
+
+
+def bench_loss(x_dim, latent_dim, n_sequences, seq_len, repeat):
+    folder = tempfile.mkdtemp()
+    results = {}
+    losses = {}
+    for name in ["former", "current"]:
+        job = dict(name=name, x_dim=x_dim, latent_dim=latent_dim, n_sequences=n_sequences, seq_len=seq_len,
+                   repeat=repeat, output=os.path.join(folder, name + ".npy"))
+        output = subprocess.check_output([sys.executable, "-m", "benchmarks.bench_loss", "--job", json.dumps(job)])
+        # The result is the last line of the output of the subprocess
+        results[name] = json.loads(output.decode().strip().splitlines()[-1])
+        losses[name] = np.load(job["output"])
+
+    assert np.allclose(losses["former"], losses["current"], rtol=1e-4, atol=1e-3), "Losses differ!"
+    former, current = results["former"], results["current"]
+    print("x_dim %3d latent_dim %4d  former: %8.4fs %8.1fMB  current: %8.4fs %8.1fMB  speedup: %5.2fx" % (
+        x_dim, latent_dim, former["s"], former["peak_growth_mb"], current["s"], current["peak_growth_mb"],
+        former["s"] / current["s"]))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="STORN loss benchmark")
+    parser.add_argument("--x-dim", type=int, default=7)
+    parser.add_argument("--latent-dim", type=int_list, default=[7, 64, 256])
+    parser.add_argument("--n-sequences", type=int, default=1024)
+    parser.add_argument("--seq-len", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--job", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.job:
+        print(json.dumps(run_job(json.loads(args.job))))
+        return
+
+    for latent_dim in args.latent_dim:
+        bench_loss(args.x_dim, latent_dim, args.n_sequences, args.seq_len, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
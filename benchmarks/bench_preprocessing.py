@@ -0,0 +1,70 @@
+"""
+Compares the vectorized preprocessing in greenarm.util against the former loop implementations.
+
+Usage: python -m benchmarks.bench_preprocessing
+"""
+import timeit
+
+import numpy as np
+
+from greenarm.util import pad_sequences_3d, subsample
+
+
+def loop_pad_sequences_3d(sequences, maxlen, return_paddings=False, skip_first_n_dims=0):
+    data_dimensionality = sequences[0].shape[-1] - skip_first_n_dims
+    data = np.zeros(shape=(len(sequences), maxlen, data_dimensionality), dtype="float32")
+
+    paddings = []
+    for sample_index, sample in enumerate(sequences):
+        if maxlen >= sample.shape[0]:
+            data[sample_index] = np.vstack(
+                (np.zeros((maxlen - sample.shape[0], data_dimensionality)), sample[:, skip_first_n_dims:])
+            )
+            paddings.append(maxlen - sample.shape[0])
+        else:
+            data[sample_index] = sample[:maxlen, skip_first_n_dims:]
+            paddings.append(0)
+
+    if return_paddings:
+        return data, paddings
+
+    return data
+
+
+def loop_subsample(sequence, step):
+    result = []
+    prev = sequence[0, 0]
+    for i, current_timestamp in enumerate(sequence[:, 0]):
+        if current_timestamp >= (prev + step):
+            result.append(sequence[i, :])
+            prev = current_timestamp
+    return np.asarray(result, dtype='float32')
+
+
+def compare(name, loop_func, vectorized_func, repeat=3):
+    loop_result = loop_func()
+    vectorized_result = vectorized_func()
+    assert np.allclose(loop_result, vectorized_result), "Results of %s differ!" % name
+
+    loop_time = min(timeit.repeat(loop_func, number=1, repeat=repeat))
+    vectorized_time = min(timeit.repeat(vectorized_func, number=1, repeat=repeat))
+    print("%-20s loop: %8.4fs  vectorized: %8.4fs  speedup: %6.1fx" % (
+        name, loop_time, vectorized_time, loop_time / vectorized_time))
+
+
+def main():
+    rng = np.random.RandomState(0)
+
+    # 20k trials of a 7 joint arm plus timestamp column, between 50 and 400 samples each
+    sequences = [rng.randn(length, 8).astype("float32") for length in rng.randint(50, 400, size=20000)]
+    compare("pad_sequences_3d", lambda: loop_pad_sequences_3d(sequences, 300, skip_first_n_dims=1),
+            lambda: pad_sequences_3d(sequences, 300, skip_first_n_dims=1))
+
+    # One million rows recorded at roughly 100Hz, sub-sampled to 20Hz
+    timestamps = np.cumsum(rng.uniform(0.009, 0.011, size=1000000))
+    log = np.column_stack([timestamps, rng.randn(timestamps.shape[0], 7)])
+    compare("subsample", lambda: loop_subsample(log, 0.05), lambda: subsample(log, 0.05))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Compares the batched gaussian smoothing of the anomaly detectors against the former
+row by row smoothing, and measures the per step cost of the causal streaming filter.
+
+Usage: python -m benchmarks.bench_smoothing --n-windows 100000 --seq-len 50
+"""
+import argparse
+import timeit
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, gaussian_filter1d
+
+from greenarm.anomaly_detection.smoothing import CausalGaussianFilter
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loss smoothing benchmark")
+    parser.add_argument("--n-windows", type=int, default=100000)
+    parser.add_argument("--seq-len", type=int, default=50)
+    parser.add_argument("--n-streams", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    loss = np.random.RandomState(0).rand(args.n_windows, args.seq_len).astype("float32")
+
+    def row_by_row():
+        return np.apply_along_axis(lambda x: gaussian_filter(x, sigma=1.), axis=-1, arr=loss)
+
+    def batched():
+        return gaussian_filter1d(loss, sigma=1., axis=-1)
+
+    assert np.allclose(row_by_row(), batched()), "Smoothed losses differ!"
+    row_time = min(timeit.repeat(row_by_row, number=1, repeat=args.repeat))
+    batched_time = min(timeit.repeat(batched, number=1, repeat=args.repeat))
+    print("%-24s row by row: %8.4fs  batched: %8.4fs  speedup: %6.1fx" % (
+        "(%d, %d) loss" % loss.shape, row_time, batched_time, row_time / batched_time))
+
+    causal = CausalGaussianFilter(args.n_streams)
+    step_loss = loss[:args.n_streams, 0]
+    step_time = min(timeit.repeat(lambda: causal.step(step_loss), number=100, repeat=args.repeat)) / 100.
+    print("%-24s causal step: %8.4fms  per stream: %8.4fus" % (
+        "%d streams" % args.n_streams, 1000. * step_time, 1e6 * step_time / args.n_streams))
+
+
+if __name__ == "__main__":
+    main()
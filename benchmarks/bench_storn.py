@@ -0,0 +1,216 @@
+"""
+Throughput benchmarks for STORN training, inference and the anomaly detectors on CPU.
+
+Every comma separated parameter value spans a grid of configurations, each runs on
+synthetic data in its own subprocess, so it gets a fresh backend session and its own
+peak memory. The results are written as JSON, so two runs can be compared between
+commits with --compare.
+
+Usage:
+    python -m benchmarks.bench_storn --n-deep 2,6 --trending 0,1 --output results.json
+    python -m benchmarks.bench_storn --compare before.json results.json
+"""
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def make_data(n_sequences, seq_len, data_dim, seed=0):
+    """
+    Noisy sine waves with a random phase and frequency per feature.
+
+    :return: the STORN inputs [x_t, x_tm1] and the target x_t
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_sequences * (seq_len + 1))[:, None]
+    data = np.sin(rng.uniform(0.01, 0.1, size=data_dim) * t + rng.uniform(0, np.pi, size=data_dim))
+    data = (data + 0.05 * rng.randn(*data.shape)).astype("float32")
+
+    windows = data.reshape(n_sequences, seq_len + 1, data_dim)
+    x_tm1, x_t = windows[:, :-1], windows[:, 1:]
+    return [x_t, x_tm1], x_t
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and is the peak of the whole process so far,
+    # every configuration runs in its own process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000.
+    return {"p50_ms": float(np.percentile(latencies, 50)),
+            "p90_ms": float(np.percentile(latencies, 90)),
+            "p99_ms": float(np.percentile(latencies, 99))}
+
+
+def bench_storn(data_dim, latent_dim, n_deep, seq_len, batch_size, trending, n_sequences, epochs, n_steps):
+    import keras.backend as K
+    from greenarm.models.STORN import STORNModel, Phases
+
+    K.clear_session()
+    inputs, target = make_data(n_sequences, seq_len, data_dim)
+    storn = STORNModel(data_dim=data_dim, latent_dim=latent_dim, n_deep=n_deep, with_trending_prior=bool(trending),
+                       output_folder=tempfile.mkdtemp(), tensorboard=False)
+    result = {}
+
+    start = time.time()
+    storn.train_model = storn._build(Phases.train, seq_shape=seq_len)
+    result["train_build_s"] = time.time() - start
+
+    start = time.time()
+    storn.predict_model = storn._build(Phases.predict, batch_size=batch_size)
+    result["predict_build_s"] = time.time() - start
+
+    # Only the training loop of the model built above, without checkpoints and logging
+    list_in = inputs + ([storn.standard_prior_input(n_sequences, seq_len)] if storn.feeds_prior_input else [])
+    start = time.time()
+    storn.train_model.fit(list_in, target, epochs=epochs, verbose=0)
+    result["fit_samples_per_s"] = epochs * n_sequences * seq_len / (time.time() - start)
+    storn.sync_predict_weights()
+
+    start = time.time()
+    storn.evaluate_offline(inputs, target)
+    result["evaluate_offline_samples_per_s"] = n_sequences * seq_len / (time.time() - start)
+
+    # One time step of batch_size streams per call
+    step_inputs = [x[:batch_size, :1] for x in inputs]
+    storn.reset_predict_model()
+    latencies = []
+    for _ in range(n_steps):
+        start = time.time()
+        storn.predict_one_step(step_inputs)
+        latencies.append(time.time() - start)
+    result["predict_one_step"] = percentiles(latencies)
+
+    return result
+
+
+def bench_detectors(seq_len, n_windows, n_steps):
+    import keras.backend as K
+    from greenarm.anomaly_detection.conv_detector import CovNetAnomalyDetector
+    from greenarm.anomaly_detection.nn_max_detector import MaxAnomalyDetector
+
+    K.clear_session()
+    loss = np.random.RandomState(0).rand(n_windows, seq_len).astype("float32")
+    result = {}
+    for name, detector in [("max_detector", MaxAnomalyDetector()), ("conv_detector", CovNetAnomalyDetector())]:
+        detector.model = detector.build_model(seq_len=1 if name == "max_detector" else seq_len)
+        latencies = []
+        for _ in range(n_steps):
+            start = time.time()
+            detector.score(loss)
+            latencies.append(time.time() - start)
+        result[name] = dict(percentiles(latencies), windows_per_s=n_windows / float(np.median(latencies)))
+    return result
+
+
+def run_isolated(job):
+    """
+    Runs one benchmark job in a new Python process and returns its result.
+    """
+    output = subprocess.check_output([sys.executable, "-m", "benchmarks.bench_storn", "--job", json.dumps(job)])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def run_job(job):
+    if job["kind"] == "storn":
+        result = bench_storn(**job["args"])
+    else:
+        result = bench_detectors(**job["args"])
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {json.dumps(run["config"], sort_keys=True): run for run in json.load(f)["runs"]}
+    with open(after_path) as f:
+        after = {json.dumps(run["config"], sort_keys=True): run for run in json.load(f)["runs"]}
+
+    def flatten(result, prefix=""):
+        for key, value in sorted(result.items()):
+            if isinstance(value, dict):
+                for item in flatten(value, prefix + key + "."):
+                    yield item
+            else:
+                yield prefix + key, value
+
+    for config in sorted(set(before) & set(after)):
+        print(config)
+        after_metrics = dict(flatten(after[config]["result"]))
+        for metric, old in flatten(before[config]["result"]):
+            new = after_metrics.get(metric)
+            if new is not None and old:
+                print("    %-40s %12.4f -> %12.4f (%+.1f%%)" % (metric, old, new, 100. * (new - old) / old))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="STORN throughput benchmarks")
+    parser.add_argument("--data-dim", type=int_list, default=[7])
+    parser.add_argument("--latent-dim", type=int_list, default=[7])
+    parser.add_argument("--n-deep", type=int_list, default=[2])
+    parser.add_argument("--seq-len", type=int_list, default=[50])
+    parser.add_argument("--batch-size", type=int_list, default=[32])
+    parser.add_argument("--trending", type=int_list, default=[0, 1])
+    parser.add_argument("--n-sequences", type=int, default=512)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--n-steps", type=int, default=200)
+    parser.add_argument("--n-windows", type=int, default=10000)
+    parser.add_argument("--skip-detectors", action="store_true")
+    parser.add_argument("--output", default="storn_benchmark.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    parser.add_argument("--job", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.job:
+        # The result is the last line of the output of the subprocess
+        print(json.dumps(run_job(json.loads(args.job))))
+        return
+
+    names = ["data_dim", "latent_dim", "n_deep", "seq_len", "batch_size", "trending"]
+    runs = []
+    for values in itertools.product(*[getattr(args, name) for name in names]):
+        config = dict(zip(names, values))
+        print("Running %s" % config)
+        result = run_isolated({"kind": "storn", "args": dict(config, n_sequences=args.n_sequences, epochs=args.epochs,
+                                                             n_steps=args.n_steps)})
+        runs.append({"config": config, "result": result})
+
+    if not args.skip_detectors:
+        for seq_len in args.seq_len:
+            config = {"detectors": True, "seq_len": seq_len}
+            print("Running %s" % config)
+            result = run_isolated({"kind": "detectors",
+                                   "args": {"seq_len": seq_len, "n_windows": args.n_windows, "n_steps": 20}})
+            runs.append({"config": config, "result": result})
+
+    with open(args.output, "w") as f:
+        json.dump({"revision": git_revision(), "runs": runs}, f, indent=4)
+    print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Checks that NumpySTORN reproduces the statistics of the Keras predict model step by step.
+
+A small STORNModel is built for every configuration, exported and fed the same random
+steps as the NumPy engine. The recognition sigma head is set to a vanishing standard
+deviation, so the latent samples of both engines equal the recognition mean. With a
+trending prior the shifted z of the predict model is random noise, so its prior
+statistics are left out of the comparison.
+
+Usage: python -m benchmarks.check_numpy_storn
+"""
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+
+def check(data_dim, latent_dim, n_deep, trending, log_variance, batch_size=4, n_steps=20):
+    import keras.backend as K
+    from greenarm.models.STORN import STORNModel
+    from greenarm.models.numpy_storn import NumpySTORN
+
+    K.clear_session()
+    folder = tempfile.mkdtemp()
+    storn = STORNModel(data_dim=data_dim, latent_dim=latent_dim, n_deep=n_deep, n_hidden_dense=16,
+                       n_hidden_recurrent=16, with_trending_prior=trending, log_variance=log_variance,
+                       output_folder=folder, tensorboard=False)
+    storn.build(seq_shape=n_steps, batch_size=batch_size)
+
+    # A softplus of -100 is 0 in float32, a log-variance of -100 is clipped to a standard deviation of 3e-7
+    sigma_layer = storn.predict_model.get_layer("recognition_sigma")
+    kernel, bias = sigma_layer.get_weights()
+    sigma_layer.set_weights([np.zeros_like(kernel), np.full_like(bias, -100.)])
+
+    path = os.path.join(folder, "storn.npz")
+    storn.export_numpy(path)
+    engine = NumpySTORN.load(path, seed=0)
+
+    x = np.random.RandomState(0).randn(batch_size, n_steps + 1, data_dim).astype("float32")
+    n_compared = 2 * data_dim + (2 if trending else 4) * latent_dim
+    storn.reset_predict_model()
+    max_error = 0.
+    for t in range(n_steps):
+        x_tm1, x_t = x[:, t], x[:, t + 1]
+        inputs = [x_t[:, None], x_tm1[:, None]]
+        if storn.feeds_prior_input:
+            inputs.append(storn.standard_prior_input(batch_size, 1))
+
+        keras_stats = storn.predict_model.predict_on_batch(inputs)[:, 0]
+        numpy_stats = np.concatenate(engine.statistics(x_t, x_tm1), axis=-1)
+        max_error = max(max_error, float(np.max(np.abs(keras_stats - numpy_stats)[:, :n_compared])))
+    return max_error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NumpySTORN parity check")
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    failed = False
+    for n_deep, trending, log_variance in itertools.product([0, 2], [False, True], [False, True]):
+        error = check(data_dim=5, latent_dim=3, n_deep=n_deep, trending=trending, log_variance=log_variance)
+        ok = error <= args.tolerance
+        failed = failed or not ok
+        print("n_deep %d trending %-5s log_variance %-5s  max abs error: %.2e  %s" % (
+            n_deep, trending, log_variance, error, "ok" if ok else "FAILED"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,11 @@
-import keras
-import keras.backend as K
 import greenarm.models.keras_fix as kf
 
 # Apply the keras fix
-
-import keras.layers as l
+# Keras is only imported inside the fix, so greenarm.models.numpy_storn can run without it
 
 def compute_mask_sum_mul_ave(self, inputs, mask=None):
+    import keras.backend as K
+
     if mask is None or all([m is None for m in mask]):
         return None
 
@@ -16,6 +15,8 @@ def compute_mask_sum_mul_ave(self, inputs, mask=None):
     return K.all(K.concatenate(masks, axis=0), axis=0, keepdims=False)
 
 def compute_mask_concat(self, inputs, mask=None):
+    import keras.backend as K
+
     if mask is None or all([m is None for m in mask]):
         return None
 
@@ -37,6 +38,7 @@ def compute_mask_concat(self, inputs, mask=None):
     return K.all(concatenated, axis=-1, keepdims=False)
 
 # Mokey Patch
+# import keras.layers as l
 # print("Applying keras fix...")
 # l.Concatenate.compute_mask = compute_mask_concat
 # l.Add.compute_mask = compute_mask_sum_mul_ave
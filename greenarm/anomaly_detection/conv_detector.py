@@ -1,7 +1,7 @@
 from keras.callbacks import ModelCheckpoint, EarlyStopping
 from keras.models import Sequential
 from keras.layers import Dense, Activation, Dropout, Convolution1D, MaxPooling1D, Flatten
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter1d
 from greenarm.models.loss.binary_crossentropy import biased_binary_crossentropy
 from greenarm.util import get_logger
 import time
@@ -49,7 +49,8 @@ class CovNetAnomalyDetector(object):
         seq_len = X.shape[1]
         X = numpy.reshape(X, (n_samples, seq_len, 1))
         y = numpy.reshape(y, (n_samples, 1))
-        X = numpy.apply_along_axis(lambda x: gaussian_filter(x, sigma=1.), axis=-1, arr=X)
+        # Smooth along the time axis, the last axis is the single feature
+        X = gaussian_filter1d(X, sigma=1., axis=1)
 
         if self.model is None:
             self.model = self.build_model(seq_len=seq_len)
@@ -78,7 +79,8 @@ class CovNetAnomalyDetector(object):
         n_samples = X.shape[0]
         seq_len = X.shape[1]
         X = numpy.reshape(X, (n_samples, seq_len, 1))
-        X = numpy.apply_along_axis(lambda x: gaussian_filter(x, sigma=1.), axis=-1, arr=X)
+        # Smooth along the time axis, the last axis is the single feature
+        X = gaussian_filter1d(X, sigma=1., axis=1)
         return self.model.predict([X])
 
     def predict(self, X):
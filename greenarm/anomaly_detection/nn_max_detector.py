@@ -1,7 +1,7 @@
 from keras.callbacks import ModelCheckpoint, EarlyStopping
 from keras.models import Sequential
 from keras.layers import Dense, Activation
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter1d
 from greenarm.models.loss.binary_crossentropy import biased_binary_crossentropy
 from greenarm.util import get_logger
 import time
@@ -40,7 +40,7 @@ class MaxAnomalyDetector(object):
         seq_len = X.shape[1]
         X = numpy.reshape(X, (n_samples, seq_len))
         y = numpy.reshape(y, (n_samples, 1))
-        X = numpy.apply_along_axis(lambda x: gaussian_filter(x, sigma=1.), axis=-1, arr=X)
+        X = gaussian_filter1d(X, sigma=1., axis=-1)
         X = numpy.max(X, axis=-1)
 
         if self.model is None:
@@ -70,7 +70,7 @@ class MaxAnomalyDetector(object):
         n_samples = X.shape[0]
         seq_len = X.shape[1]
         X = numpy.reshape(X, (n_samples, seq_len))
-        X = numpy.apply_along_axis(lambda x: gaussian_filter(x, sigma=1.), axis=-1, arr=X)
+        X = gaussian_filter1d(X, sigma=1., axis=-1)
         X = numpy.max(X, axis=-1)
         return self.model.predict([X])
 
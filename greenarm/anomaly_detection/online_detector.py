@@ -0,0 +1,88 @@
+from greenarm.anomaly_detection.smoothing import CausalGaussianFilter
+from greenarm.util import get_logger
+import numpy
+
+logger = get_logger(__name__)
+
+
+class OnlineAnomalyDetector(object):
+    """
+    The Online Anomaly Detector consumes the STORN loss of several streams one step at a time.
+    Every stream keeps a causally smoothed loss and its running maximum over the last window
+    steps, which raises an alarm as soon as it exceeds the threshold of the stream. Every
+    step costs the same, so a decision is available after every step.
+
+    The thresholds are taken from a trained ThresholdAnomalyDetector or MaxAnomalyDetector.
+    Both smooth offline with a centered gaussian, the causal one lags behind it by a few
+    steps and peaks slightly lower.
+    """
+
+    def __init__(self, thresholds, sigma=1., window=None):
+        """
+        :param thresholds: the threshold of every stream, shape (n_streams,)
+        :param sigma: the standard deviation of the causal gaussian smoothing
+        :param window: the number of steps of the running maximum, all steps since the last reset if None
+        """
+        self.thresholds = numpy.asarray(thresholds, dtype="float64").ravel()
+        self.n_streams = self.thresholds.shape[0]
+        self.window = window
+
+        # Object state
+        self.filter = CausalGaussianFilter(self.n_streams, sigma=sigma)
+        self.recent = numpy.full((self.n_streams, window or 1), -numpy.inf)
+        self.position = 0
+        self.running_max = numpy.full(self.n_streams, -numpy.inf)
+
+    @classmethod
+    def from_threshold_detector(cls, detector, n_streams, stream_ids=None, window=None):
+        """
+        :param detector: a trained ThresholdAnomalyDetector
+        :param stream_ids: the stream id of every row, for the per stream thresholds
+        """
+        return cls(detector.thresholds(n_streams, stream_ids), sigma=detector.sigma, window=window)
+
+    @classmethod
+    def from_max_detector(cls, detector, n_streams, sensitivity=0.5, window=None):
+        """
+        The MaxAnomalyDetector predicts an anomaly where sigmoid(w * max + b) > sensitivity,
+        which is a threshold on the smoothed maximum if w is positive.
+
+        :param detector: a trained MaxAnomalyDetector
+        """
+        kernel, bias = detector.model.layers[0].get_weights()
+        w, b = float(kernel.ravel()[0]), float(bias.ravel()[0])
+        if w <= 0.:
+            raise ValueError("The MaxAnomalyDetector does not increase with the loss and has no threshold!")
+
+        threshold = (numpy.log(sensitivity / (1. - sensitivity)) - b) / w
+        logger.info("Threshold of the MaxAnomalyDetector: %s" % threshold)
+        return cls(numpy.full(n_streams, threshold), window=window)
+
+    def reset(self, rows=None):
+        """
+        Forgets the history of some streams, or of all streams if no rows are given.
+        """
+        rows = slice(None) if rows is None else rows
+        self.filter.reset(rows)
+        self.recent[rows] = -numpy.inf
+        self.running_max[rows] = -numpy.inf
+
+    def score_step(self, loss):
+        """
+        :param loss: the STORN loss of the current step of every stream, shape (n_streams,)
+        :return: the running maximum of the smoothed loss of every stream
+        """
+        smoothed = self.filter.step(loss)
+        if self.window is None:
+            self.running_max = numpy.maximum(self.running_max, smoothed)
+        else:
+            self.position = (self.position + 1) % self.window
+            self.recent[:, self.position] = smoothed
+            self.running_max = numpy.max(self.recent, axis=-1)
+        return self.running_max
+
+    def predict_step(self, loss):
+        """
+        :return: the alarms of the current step, shape (n_streams,)
+        """
+        return self.score_step(loss) > self.thresholds
@@ -1,4 +1,5 @@
 import time
+import numpy
 from keras.callbacks import ModelCheckpoint, EarlyStopping, RemoteMonitor
 from keras.models import Model
 from keras.layers import Input, TimeDistributed, Dense, Dropout, Masking, GRU
@@ -27,12 +28,17 @@ class RNNAnomalyDetector(object):
 
         # Object state
         self.model = None
+        self.streaming_model = None
 
         # Misc
         self.monitor = True
 
-    def build_model(self, seq_len=None):
-        loss_input = Input(shape=(seq_len, 33))
+    def build_model(self, seq_len=None, batch_size=None, stateful=False):
+        if stateful:
+            # One step of batch_size streams per call, the GRU keeps the states in between
+            loss_input = Input(batch_shape=(batch_size, 1, 33))
+        else:
+            loss_input = Input(shape=(seq_len, 33))
         masked_input = Masking()(loss_input)
 
         # deep feature extraction for the loss
@@ -43,7 +49,7 @@ class RNNAnomalyDetector(object):
                 deep = Dropout(self.dropout)(deep)
 
         # RNN node to process the loss time-series
-        rnn = RecurrentLayer(self.n_hidden_recurrent, return_sequences=False, stateful=False)(deep)
+        rnn = RecurrentLayer(self.n_hidden_recurrent, return_sequences=False, stateful=stateful)(deep)
 
         # deep feature extraction for the RNN output
         output = rnn
@@ -95,6 +101,30 @@ class RNNAnomalyDetector(object):
     def score(self, X):
         return self.model.predict([X])
 
+    def build_streaming_model(self, batch_size):
+        """
+        Builds a stateful copy of the trained model for batch_size streams. It scores one
+        step per call, so a decision is available after every step instead of at the end
+        of a window.
+        """
+        self.streaming_model = self.build_model(batch_size=batch_size, stateful=True)
+        # Both models have the same layers, so the weights can be copied in memory
+        self.streaming_model.set_weights(self.model.get_weights())
+
+    def score_step(self, X_t):
+        """
+        :param X_t: the loss features of the current step of every stream, shape (batch_size, 33)
+        :return: the anomaly probability of every stream given all steps since the last reset
+        """
+        X_t = numpy.reshape(X_t, (X_t.shape[0], 1, X_t.shape[-1]))
+        return self.streaming_model.predict_on_batch([X_t])[:, 0]
+
+    def predict_step(self, X_t, sensitivity=0.5):
+        return self.score_step(X_t) > sensitivity
+
+    def reset_streaming_states(self):
+        self.streaming_model.reset_states()
+
     def predict(self, X):
         return self.score(X) > 0.5
 
@@ -0,0 +1,75 @@
+"""
+Gaussian smoothing of the STORN loss for streams that arrive one step at a time.
+"""
+import numpy
+
+
+def causal_gaussian_weights(sigma=1., truncate=4.):
+    """
+    The weights of a one-sided gaussian over the current and the past steps, the first
+    weight belongs to the current step.
+    """
+    radius = int(truncate * sigma + 0.5)
+    weights = numpy.exp(-0.5 * numpy.square(numpy.arange(radius + 1) / float(sigma)))
+    return weights / weights.sum()
+
+
+def causal_gaussian_filter(X, sigma=1., truncate=4.):
+    """
+    Smooths a batch of series along the last axis with the causal gaussian, like
+    CausalGaussianFilter does step by step. The series are extended with their first
+    value into the past.
+    """
+    weights = causal_gaussian_weights(sigma, truncate)
+    X = numpy.asarray(X, dtype="float64")
+    padded = numpy.concatenate([numpy.repeat(X[..., :1], weights.shape[0] - 1, axis=-1), X], axis=-1)
+
+    smoothed = numpy.zeros(X.shape)
+    seq_len = X.shape[-1]
+    for lag, weight in enumerate(weights):
+        start = weights.shape[0] - 1 - lag
+        smoothed += weight * padded[..., start:start + seq_len]
+    return smoothed
+
+
+class CausalGaussianFilter(object):
+    """
+    Smooths the loss of several streams incrementally with a one-sided gaussian, so every
+    step costs the same and depends on the current and past steps only. The history of a
+    stream starts with its first value.
+    """
+
+    def __init__(self, n_streams, sigma=1., truncate=4.):
+        self.n_streams = n_streams
+        self.weights = causal_gaussian_weights(sigma, truncate)
+
+        # Object state, a ring buffer of the recent values of every stream
+        self.history = numpy.zeros((n_streams, self.weights.shape[0]))
+        self.started = numpy.zeros(n_streams, dtype=bool)
+        self.position = 0
+
+    def reset(self, rows=None):
+        """
+        Forgets the history of some streams, or of all streams if no rows are given.
+        """
+        if rows is None:
+            self.started[:] = False
+        else:
+            self.started[rows] = False
+
+    def step(self, values):
+        """
+        :param values: the loss of the current step of every stream, shape (n_streams,)
+        :return: the smoothed loss of every stream, shape (n_streams,)
+        """
+        values = numpy.asarray(values, dtype="float64").ravel()
+
+        # New streams are filled with their first value
+        self.history[~self.started] = values[~self.started, None]
+        self.started[:] = True
+
+        self.position = (self.position + 1) % self.weights.shape[0]
+        self.history[:, self.position] = values
+
+        lags = (self.position - numpy.arange(self.weights.shape[0])) % self.weights.shape[0]
+        return numpy.dot(self.history[:, lags], self.weights)
@@ -0,0 +1,108 @@
+from scipy.ndimage import gaussian_filter1d
+from greenarm.metrics import confusion_counts, scores_from_counts
+from greenarm.util import get_logger
+import json
+import time
+import numpy
+
+logger = get_logger(__name__)
+
+
+class ThresholdAnomalyDetector(object):
+    """
+    The Threshold Anomaly Detector thresholds the smoothed maximum of the loss value of the STORN model
+    in every window. No network is trained: the threshold is the quantile of the scores of the normal
+    windows that yields the target false positive rate, optionally one threshold per stream.
+    Windows with a score strictly above their threshold are predicted anomalous, like
+    greenarm.metrics counts them.
+    """
+
+    def __init__(self, target_fpr=0.01, sigma=1., min_stream_samples=100):
+        if not 0. <= target_fpr < 1.:
+            raise ValueError("The target false positive rate has to be in [0, 1), got {}!".format(target_fpr))
+        # false positive rate on the normal training windows
+        self.target_fpr = target_fpr
+        # standard deviation of the gaussian smoothing along the time axis
+        self.sigma = sigma
+        # streams with fewer normal windows use the global threshold
+        self.min_stream_samples = min_stream_samples
+
+        # Object state
+        self.threshold = None
+        self.stream_thresholds = {}
+
+    def window_scores(self, X):
+        n_samples = X.shape[0]
+        seq_len = X.shape[1]
+        X = numpy.reshape(X, (n_samples, seq_len))
+        return numpy.max(gaussian_filter1d(X, sigma=self.sigma, axis=-1), axis=-1)
+
+    def quantile_threshold(self, scores):
+        """
+        The smallest threshold that at most target_fpr of the scores exceed.
+        """
+        scores = numpy.sort(scores)
+        n_false_positives = int(numpy.floor(self.target_fpr * scores.shape[0]))
+        return float(scores[scores.shape[0] - n_false_positives - 1])
+
+    def train(self, X, y=None, stream_ids=None):
+        """
+        :param X: the STORN loss of the windows, shape (n_samples, seq_len)
+        :param y: the labels of the windows, all windows are taken as normal if not given
+        :param stream_ids: the stream of every window, to fit one threshold per stream
+        """
+        scores = self.window_scores(X)
+        normal = numpy.ones(scores.shape[0], dtype=bool) if y is None else ~numpy.asarray(y, dtype=bool).ravel()
+        if not normal.any():
+            raise ValueError("Thresholds can only be fit with normal windows!")
+
+        self.threshold = self.quantile_threshold(scores[normal])
+        self.stream_thresholds = {}
+        if stream_ids is not None:
+            stream_ids = numpy.asarray(stream_ids).ravel()
+            for stream_id in numpy.unique(stream_ids[normal]):
+                stream_scores = scores[normal & (stream_ids == stream_id)]
+                if stream_scores.shape[0] >= self.min_stream_samples:
+                    self.stream_thresholds[stream_id.item()] = self.quantile_threshold(stream_scores)
+
+        logger.info("Threshold: %s, %d stream thresholds" % (self.threshold, len(self.stream_thresholds)))
+        if y is not None:
+            predicted = scores > self.thresholds(scores.shape[0], stream_ids)
+            logger.info("Training scores: %s" % scores_from_counts(*confusion_counts(predicted, ~normal)))
+
+        self.save()
+
+    def thresholds(self, n_samples, stream_ids=None):
+        if stream_ids is None:
+            return numpy.full(n_samples, self.threshold)
+        return numpy.array([self.stream_thresholds.get(stream_id, self.threshold)
+                            for stream_id in numpy.asarray(stream_ids).ravel().tolist()])
+
+    def score(self, X):
+        return self.window_scores(X)[:, None]
+
+    def predict(self, X, stream_ids=None):
+        return self.score(X) > self.thresholds(X.shape[0], stream_ids)[:, None]
+
+    def save(self, prefix=None):
+        if prefix is None:
+            prefix = "saved_models/ThresholdAnomalyDetector_%s.model" % int(time.time())
+
+        logger.info("Saving model to %s" % prefix)
+
+        with open(prefix + ".json", "w") as of:
+            json.dump({"target_fpr": self.target_fpr, "sigma": self.sigma,
+                       "min_stream_samples": self.min_stream_samples, "threshold": self.threshold,
+                       "stream_thresholds": list(self.stream_thresholds.items())}, of, indent=4)
+        return prefix
+
+    @classmethod
+    def load(cls, prefix):
+        with open(prefix + ".json", "r") as f:
+            params = json.load(f)
+
+        instance = cls(target_fpr=params["target_fpr"], sigma=params["sigma"],
+                       min_stream_samples=params["min_stream_samples"])
+        instance.threshold = params["threshold"]
+        instance.stream_thresholds = dict((stream_id, threshold) for stream_id, threshold in params["stream_thresholds"])
+        return instance
@@ -0,0 +1,138 @@
+"""
+Vectorized evaluation metrics for the anomaly detectors.
+
+ConfusionHistogram accumulates the scores of positive and negative samples in a fixed
+histogram, so shards evaluated in parallel can be merged, and yields the confusion
+counts, precision, recall, F1 and an approximate ROC-AUC for any threshold in one pass.
+
+Throughout the package a sample is predicted positive if its score is strictly greater
+than the threshold, like the predict methods of the anomaly detectors do.
+"""
+import numpy as np
+
+
+def confusion_counts(predicted, ground_truth):
+    """
+    Counts the true and false positives and negatives of binary predictions.
+
+    :param predicted: the predicted labels, any shape
+    :param ground_truth: the true labels, same number of elements
+    :return: tp, fp, tn, fn
+    """
+    predicted = np.asarray(predicted, dtype=bool).ravel()
+    ground_truth = np.asarray(ground_truth, dtype=bool).ravel()
+
+    tp = int(np.count_nonzero(predicted & ground_truth))
+    fp = int(np.count_nonzero(predicted & ~ground_truth))
+    fn = int(np.count_nonzero(~predicted & ground_truth))
+    tn = predicted.shape[0] - tp - fp - fn
+    return tp, fp, tn, fn
+
+
+def scores_from_counts(tp, fp, tn, fn):
+    """
+    :return: a dict with the precision, recall, specificity and F1, 0 where undefined
+    """
+    def ratio(numerator, denominator):
+        return numerator / float(denominator) if denominator else 0.
+
+    precision = ratio(tp, tp + fp)
+    recall = ratio(tp, tp + fn)
+    return {
+        "precision": precision,
+        "recall": recall,
+        "specificity": ratio(tn, tn + fp),
+        "f1": ratio(2. * precision * recall, precision + recall)
+    }
+
+
+class ConfusionHistogram(object):
+    """
+    Counts the scores of the positive and negative samples in fixed bins. Every bin holds
+    the scores above its left edge up to and including its right edge, so the scores above
+    a threshold are a suffix of the bins. Thresholds are rounded up to the next bin edge,
+    so the counts are exact for thresholds on the edges and the ROC-AUC is exact up to the
+    ties inside a bin. Scores outside the range are counted in an underflow and an overflow
+    bin, so they are exact as well, but the ROC-AUC loses resolution if the range does not
+    cover most of the scores.
+    """
+
+    def __init__(self, min_score, max_score, n_bins=1000):
+        """
+        :param min_score: the lower end of the binned range, STORN losses can be negative
+        :param max_score: the upper end of the binned range
+        :param n_bins: the number of bins between min_score and max_score
+        """
+        if not min_score < max_score:
+            raise ValueError("The score range [{}, {}] is empty!".format(min_score, max_score))
+        # The outer edges bound the underflow and the overflow bin
+        self.edges = np.concatenate([[-np.inf], np.linspace(min_score, max_score, n_bins + 1), [np.inf]])
+        self.positives = np.zeros(n_bins + 2, dtype="int64")
+        self.negatives = np.zeros(n_bins + 2, dtype="int64")
+
+    @property
+    def n_bins(self):
+        # Including the underflow and the overflow bin
+        return self.positives.shape[0]
+
+    def _bins(self, scores):
+        return np.clip(np.searchsorted(self.edges, scores, side="left") - 1, 0, self.n_bins - 1)
+
+    def update(self, scores, labels):
+        """
+        Adds a batch of scores and their binary labels.
+        """
+        scores = np.asarray(scores, dtype="float64").ravel()
+        labels = np.asarray(labels, dtype=bool).ravel()
+        bins = self._bins(scores)
+        self.positives += np.bincount(bins[labels], minlength=self.n_bins)
+        self.negatives += np.bincount(bins[~labels], minlength=self.n_bins)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the counts of a histogram with the same bins, e.g. of another shard.
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Only histograms with the same bins can be merged!")
+        self.positives += other.positives
+        self.negatives += other.negatives
+        return self
+
+    def _suffix_counts(self):
+        # The number of samples above the left edge of every bin, and zero above the last bin
+        positives = np.append(np.cumsum(self.positives[::-1])[::-1], 0)
+        negatives = np.append(np.cumsum(self.negatives[::-1])[::-1], 0)
+        return positives, negatives
+
+    def confusion(self, threshold):
+        """
+        :return: tp, fp, tn, fn when the scores above the threshold are predicted positive
+        """
+        index = min(np.searchsorted(self.edges, threshold, side="left"), self.n_bins)
+        positives, negatives = self._suffix_counts()
+        tp, fp = int(positives[index]), int(negatives[index])
+        return tp, fp, int(negatives[0]) - fp, int(positives[0]) - tp
+
+    def scores(self, threshold):
+        """
+        :return: a dict with the precision, recall, specificity and F1 at the threshold
+        """
+        return scores_from_counts(*self.confusion(threshold))
+
+    def roc(self):
+        """
+        :return: the false positive rates, true positive rates and thresholds, by increasing rates
+        """
+        positives, negatives = self._suffix_counts()
+        tp_rate = positives[::-1] / float(max(positives[0], 1))
+        fp_rate = negatives[::-1] / float(max(negatives[0], 1))
+        thresholds = np.append(self.edges[:-1], np.inf)[::-1]
+        return fp_rate, tp_rate, thresholds
+
+    def auc(self):
+        """
+        :return: the area under the ROC curve by the trapezoidal rule
+        """
+        fp_rate, tp_rate, _ = self.roc()
+        return float(np.sum(np.diff(fp_rate) * (tp_rate[1:] + tp_rate[:-1]) / 2.))
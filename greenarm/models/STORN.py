@@ -6,22 +6,40 @@ import numpy as np
 import time
 import os
 import json
+import weakref
 
 import keras.backend as K
-from keras.callbacks import ModelCheckpoint, EarlyStopping, RemoteMonitor, TensorBoard
+from keras.callbacks import CallbackList, EarlyStopping, RemoteMonitor, TensorBoard
 from keras.models import Model
 from keras.optimizers import Adam
-from keras.layers import Input, TimeDistributed, Dense, Dropout, GRU, SimpleRNN, Concatenate, LSTM
+from keras.layers import Input, TimeDistributed, Dense, Dropout, GRU, SimpleRNN, Concatenate, LSTM, Masking
 from keras.layers import deserialize
+from keras.utils import Sequence
+from greenarm.models.callbacks import TimedModelCheckpoint, TimingCallback
 from greenarm.models.keras_fix.lambdawithmasking import LambdaWithMasking
-from greenarm.models.loss.variational import keras_variational_func
+from greenarm.models.keras_fix.stateful_shift import StatefulShift
+from greenarm.models.loss.variational import clip_log_var, keras_variational_func
+from greenarm.models.numpy_storn import export_weights
 from greenarm.models.sampling.sampling import sample_gauss, sample_bernoulli
-from greenarm.util import add_samples_until_divisible, get_logger
+from greenarm.util import generate_shifted, get_logger, iter_batches, pad_sequences_3d
 
 logger = get_logger(__name__)
 
 RecurrentLayer = LSTM
 
+# Compiled models, their initial weights and a weak reference to the STORNModel using them,
+# by hyper-parameters, phase, sequence length and batch size
+_model_cache = {}
+
+
+def clear_model_cache():
+    """
+    Drops all cached models and clears the backend session, which releases the graph nodes
+    of all models built so far. STORN models created before must be built again.
+    """
+    _model_cache.clear()
+    K.clear_session()
+
 
 # enum for different phases
 class Phases:
@@ -35,7 +53,8 @@ class Phases:
 class STORNModel(object):
     def __init__(self, latent_dim=7, data_dim=7, n_hidden_dense=50, n_hidden_recurrent=128, rec="gauss",
                  n_deep=6, dropout=0, activation='tanh', with_trending_prior=False, monitor=False, 
-                 output_folder=None, prefix=None, embedding=None, learning_rate=0.001):
+                 output_folder=None, prefix=None, embedding=None, learning_rate=0.001, in_graph_prior=False,
+                 tensorboard=True, timing_log=None, cache_models=False, masking=False, log_variance=False):
         # Tensor shapes
         self.data_dim = data_dim
         self.latent_dim = latent_dim
@@ -52,15 +71,30 @@ class STORNModel(object):
 
         # STORN options
         self.with_trending_prior = with_trending_prior
+        # Generate the constant standard prior inside the graph instead of feeding it
+        self.in_graph_prior = in_graph_prior
+        # Skip all-zero (padded) time steps in the recurrent layers and the loss
+        self.masking = masking
+        # The Gaussian heads emit the log-variance instead of the standard deviation
+        self.log_variance = log_variance
 
         # Model states
         self.z_prior_model = None
         self.z_recognition_model = None
         self.train_model = None
         self.predict_model = None
+        self._loss_function = None
+        self._mc_model = None
+        self._mc_samples = None
 
         # Misc
         self.monitor = monitor
+        # False disables TensorBoard, a dict overrides the TensorBoard arguments
+        self.tensorboard = tensorboard
+        # Path of a JSON lines log with the per batch timings of the training
+        self.timing_log = timing_log
+        # Reuse compiled models of instances with the same hyper-parameters
+        self.cache_models = cache_models
         self.output_folder = output_folder or ""
         self.prefix = prefix or ""
 
@@ -88,6 +122,9 @@ class STORNModel(object):
             "dropout": self.dropout,
             "activation": self.activation,
             "with_trending_prior": self.with_trending_prior,
+            "in_graph_prior": self.in_graph_prior,
+            "masking": self.masking,
+            "log_variance": self.log_variance,
             "output_folder": self.output_folder,
             "prefix": self.prefix,
             "embedding": {'class_name': self.embedding.__class__.__name__,
@@ -103,20 +140,39 @@ class STORNModel(object):
                 param = deserialize(param, custom_objects=custom_objects)
             setattr(self, param_name, param)
 
+        # The compiled loss depends on the dimensions
+        self._loss_function = None
         return self
 
-    def _build(self, phase, seq_shape=None, batch_size=None):
+    @property
+    def feeds_prior_input(self):
+        """
+        Whether the standard prior statistics are a model input that has to be fed from the host.
+        """
+        return not (self.with_trending_prior or self.in_graph_prior)
+
+    def standard_prior_input(self, n_sequences, seq_len):
+        """
+        The statistics of the standard prior, fed if feeds_prior_input is set.
+        """
+        return STORNPriorModel.standard_input(n_sequences, seq_len, self.latent_dim, mode=self.rec,
+                                              log_variance=self.log_variance)
+
+    def _build(self, phase, seq_shape=None, batch_size=None, mc_samples=1, stateful=False):
         # Recognition model
 
         with K.name_scope("recognition_model"):
             self.z_recognition_model = STORNRecognitionModel(self.data_dim, self.latent_dim, self.n_hidden_dense,
                                                             self.n_hidden_recurrent, self.n_deep, self.dropout,
-                                                            self.activation, rec=self.rec)
+                                                            self.activation, rec=self.rec, masking=self.masking,
+                                                            log_variance=self.log_variance)
 
-            self.z_recognition_model.build(phase=phase, seq_shape=seq_shape, batch_size=batch_size, embedding=self.embedding)
+            self.z_recognition_model.build(phase=phase, seq_shape=seq_shape, batch_size=batch_size, embedding=self.embedding,
+                                           n_samples=mc_samples, stateful=stateful)
 
             if phase == Phases.train:
-                x_tm1 = Input(shape=(seq_shape, self.data_dim), name="storn_input_train", dtype="float32")
+                x_tm1 = Input(batch_shape=(batch_size if stateful else None, seq_shape, self.data_dim),
+                              name="storn_input_train", dtype="float32")
                 z_t = self.z_recognition_model.train_z_t
                 x_t = self.z_recognition_model.train_input
                 z_post_stats = self.z_recognition_model.train_recogn_stats
@@ -126,73 +182,150 @@ class STORNModel(object):
                 x_t = self.z_recognition_model.predict_input
                 z_post_stats = self.z_recognition_model.predict_recogn_stats
 
+            # Monte Carlo evaluation runs the generative branch once per latent sample
+            x_tm1_input = x_tm1
+            if mc_samples > 1:
+                x_tm1 = STORNModel.tile_samples_layer(mc_samples)(x_tm1)
+
         with K.name_scope("prior_model"):
             # Prior model
             if self.with_trending_prior:
-                z_tm1 = LambdaWithMasking(STORNModel.shift_z, output_shape=self.shift_z_output_shape)(z_t)
+                if stateful:
+                    # Chunks of the same sequences continue with the last z of the previous chunk
+                    z_tm1 = StatefulShift(name="shift_z")(z_t)
+                else:
+                    z_tm1 = LambdaWithMasking(STORNModel.shift_z, output_shape=self.shift_z_output_shape)(z_t)
                 self.z_prior_model = STORNPriorModel(self.latent_dim, self.with_trending_prior,
-                                                    n_hidden_recurrent=self.n_hidden_recurrent, x_tm1=x_tm1, z_tm1=z_tm1)
+                                                    n_hidden_recurrent=self.n_hidden_recurrent, x_tm1=x_tm1, z_tm1=z_tm1,
+                                                    log_variance=self.log_variance)
             else:
-                self.z_prior_model = STORNPriorModel(self.latent_dim, self.with_trending_prior)
+                self.z_prior_model = STORNPriorModel(self.latent_dim, self.with_trending_prior, x_tm1=x_tm1, rec=self.rec,
+                                                     in_graph=self.in_graph_prior, log_variance=self.log_variance)
 
-            self.z_prior_model.build(phase=phase, seq_shape=seq_shape, batch_size=batch_size)
+            self.z_prior_model.build(phase=phase, seq_shape=seq_shape, batch_size=batch_size, stateful=stateful)
 
             if phase == Phases.train:
                 z_prior_stats = self.z_prior_model.train_prior_stats
             else:
                 z_prior_stats = self.z_prior_model.predict_prior_stats
 
+            prior_input = z_prior_stats
+            if mc_samples > 1 and self.feeds_prior_input:
+                z_prior_stats = STORNModel.tile_samples_layer(mc_samples)(z_prior_stats)
+
         with K.name_scope("generative_model"):
             # Generative model
 
-            # Fix of keras/engine/topology.py required for masked layer!
-            # Otherwise concat with masked and non masked layer returns an error!
-            # masked = Masking()(x_tm1)
-            # gen_input = merge(inputs=[masked, z_t], mode='concat')
-
-            # Unmasked Layer
+            # With masking, z_t carries the mask of x_t and Concatenate merges it with the unmasked x_tm1
             gen_input = Concatenate(axis=-1, name="generative_input")([x_tm1, z_t])
 
             for i in range(self.n_deep):
-                gen_input = TimeDistributed(Dense(self.n_hidden_dense, activation=self.activation))(gen_input)
+                gen_input = TimeDistributed(Dense(self.n_hidden_dense, activation=self.activation),
+                                            name="generative_input_%d" % i)(gen_input)
                 if self.dropout != 0:
                     gen_input = Dropout(self.dropout)(gen_input)
 
-            rnn_gen = RecurrentLayer(self.n_hidden_recurrent, return_sequences=True, stateful=(phase == Phases.predict))(gen_input)
+            rnn_gen = RecurrentLayer(self.n_hidden_recurrent, return_sequences=True,
+                                     stateful=(phase == Phases.predict or stateful),
+                                     name="generative_rnn")(gen_input)
             gen_map = rnn_gen
             for i in range(self.n_deep):
-                gen_map = TimeDistributed(Dense(self.n_hidden_dense, activation=self.activation))(gen_map)
+                gen_map = TimeDistributed(Dense(self.n_hidden_dense, activation=self.activation),
+                                          name="generative_map_%d" % i)(gen_map)
                 if self.dropout != 0:
                     gen_map = Dropout(self.dropout)(gen_map)
 
             # Output statistics for the generative model
-            gen_mu = TimeDistributed(Dense(self.data_dim, activation='linear' if self.rec == "gauss" else "sigmoid"))(gen_map)
-            gen_sigma = TimeDistributed(Dense(self.data_dim, activation="softplus"))(gen_map)
+            gen_mu = TimeDistributed(Dense(self.data_dim, activation='linear' if self.rec == "gauss" else "sigmoid"),
+                                     name="generative_mu")(gen_map)
+            gen_sigma = TimeDistributed(Dense(self.data_dim, activation=sigma_activation(self.log_variance)),
+                                        name="generative_sigma")(gen_map)
 
         # Combined model
         output = Concatenate(axis=-1)([gen_mu, gen_sigma, z_post_stats, z_prior_stats])
-        inputs = [x_t, x_tm1] if self.with_trending_prior else [x_t, x_tm1, z_prior_stats]
+        inputs = [x_t, x_tm1_input, prior_input] if self.feeds_prior_input else [x_t, x_tm1_input]
+
+        if mc_samples > 1:
+            # Reduce the losses of all samples to their mean and variance, the model is only used for predictions
+            moments = LambdaWithMasking(STORNModel.loss_moments, output_shape=STORNModel.loss_moments_output_shape,
+                                        mask_function=lambda x, mask: None if mask is None else mask[0],
+                                        arguments={'x_dim': self.data_dim, 'latent_dim': self.latent_dim,
+                                                   'rec': self.rec, 'n_samples': mc_samples,
+                                                   'log_variance': self.log_variance})([x_t, output])
+            return Model(inputs=inputs, outputs=moments)
+
         model = Model(inputs=inputs, outputs=output)
         adam = Adam(lr=self.learning_rate)
-        model.compile(optimizer=adam, loss=keras_variational_func(self.data_dim, self.latent_dim, rec=self.rec))
+        model.compile(optimizer=adam, loss=keras_variational_func(self.data_dim, self.latent_dim, rec=self.rec,
+                                                                  log_variance=self.log_variance))
         # metrics=[keras_gauss, keras_divergence, mu_minus_x, mean_sigma]
 
         return model
 
+    def _get_model(self, phase, seq_shape=None, batch_size=None, stateful=False):
+        """
+        Builds a model, or takes it from the model cache if cache_models is set.
+        Cached models are reset to their initial weights and optimizer state, so they behave
+        like new ones. A cached model belongs to one instance at a time and is handed on once
+        that instance is garbage collected, so instances with the same hyper-parameters can be
+        used side by side. Models with an embedding are never cached.
+        """
+        if not self.cache_models or self.embedding:
+            return self._build(phase, seq_shape=seq_shape, batch_size=batch_size, stateful=stateful)
+
+        params = self.get_params()
+        for param_name in ("output_folder", "prefix"):
+            params.pop(param_name)
+        key = (json.dumps(params, sort_keys=True), self.rec, self.learning_rate, phase, seq_shape, batch_size, stateful)
+
+        entries = _model_cache.setdefault(key, [])
+        for entry in entries:
+            owner = entry[0]()
+            if owner is None or owner is self:
+                break
+        else:
+            model = self._build(phase, seq_shape=seq_shape, batch_size=batch_size, stateful=stateful)
+            entries.append([weakref.ref(self), model, model.get_weights()])
+            return model
+
+        logger.debug("Reusing cached model for %s" % (key,))
+        entry[0] = weakref.ref(self)
+        _, model, initial_weights = entry
+        model.set_weights(initial_weights)
+        K.batch_set_value([(w, np.zeros(K.int_shape(w))) for w in model.optimizer.weights])
+        if phase == Phases.predict or stateful:
+            model.reset_states()
+        return model
+
     def build(self, seq_shape=None, batch_size=None):
-        self.train_model = self._build(Phases.train, seq_shape=seq_shape)
-        self.predict_model = self._build(Phases.predict, batch_size=batch_size)
+        self.train_model = self._get_model(Phases.train, seq_shape=seq_shape)
+        self.predict_model = self._get_model(Phases.predict, batch_size=batch_size)
 
     def load_predict_weights(self, weights_file):
-        # self.train_model.save_weights("storn_weights.h5", overwrite=True)
-        self.predict_model.load_weights(weights_file)
+        # The file is read once, the predict model gets the weights in memory
         self.train_model.load_weights(weights_file)
+        self.sync_predict_weights()
         return True
 
+    def sync_predict_weights(self):
+        """
+        Copies the weights of the train model into the predict model without disk I/O.
+        """
+        if self.predict_model is not None:
+            copy_weights(self.train_model, self.predict_model)
+
+    def export_numpy(self, path, precision="float32"):
+        """
+        Exports the predict weights to a .npz archive for the Keras-free NumpySTORN.
+
+        :param precision: "float32", or "float16" / "int8" for smaller archives, see numpy_storn.accuracy_report
+        """
+        export_weights(self, path, precision=precision)
+
     def reset_predict_model(self):
         self.predict_model.reset_states()
 
-    def fit(self, inputs, target, max_epochs=10, validation_split=0.1):
+    def fit(self, inputs, target, max_epochs=10, validation_split=0.1, initial_weights=None, callbacks=None):
         n_sequences = target.shape[0]
         seq_len = target.shape[1]
         data_dim = target.shape[2]
@@ -200,35 +333,185 @@ class STORNModel(object):
 
         # Build the train model
         list_in = inputs[:]
-        if not self.with_trending_prior:
-            list_in.append(STORNPriorModel.standard_input(n_sequences, seq_len, self.latent_dim, mode=self.rec))
-        self.train_model = self._build(Phases.train, seq_shape=seq_len)
-        # self.train_model.load_weights("start_weights.h5")
+        if self.feeds_prior_input:
+            list_in.append(self.standard_prior_input(n_sequences, seq_len))
+        self.train_model = self._get_model(Phases.train, seq_shape=seq_len)
+        if initial_weights:
+            self.train_model.load_weights(initial_weights)
 
         # Do a validation split of all the inputs
         split_idx = int((1. - validation_split) * n_sequences)
         train_input, valid_input = [list(t) for t in zip(*[(X[:split_idx], X[split_idx:]) for X in list_in])]
         train_target, valid_target = target[:split_idx], target[split_idx:]
 
-        # Save the parameters
-        with open(os.path.join(self.output_folder, self.prefix + "parameters.json"), "w") as f:
-            json.dump(self.get_params(), f, indent=4)
+        weights_path = self._save_params()
+        try:
+            self.train_model.fit(train_input, train_target, epochs=max_epochs, validation_data=(valid_input, [valid_target]),
+                                 callbacks=self._callbacks(weights_path, extra_callbacks=callbacks))
+        except KeyboardInterrupt:
+            logger.info("Training interrupted! Restoring best weights and saving..")
+
+        # Reload the best weights
+        self.train_model.load_weights(weights_path)
+        self.sync_predict_weights()
+
+    def fit_generator(self, train_data, validation_data=None, max_epochs=10, seq_len=None, steps_per_epoch=None,
+                      validation_steps=None, workers=1, use_multiprocessing=False, callbacks=None):
+        """
+        Trains out of core on batches served by a STORNSequence or a generator, so only one
+        batch has to be held in memory at a time.
+
+        :param train_data: a STORNSequence or a generator yielding (inputs, target) batches
+        :param validation_data: a STORNSequence or a generator for the validation batches
+        :param max_epochs: the maximal number of epochs
+        :param seq_len: the sequence length of the batches, taken from a STORNSequence if not given
+        :param steps_per_epoch: number of batches per epoch, required for plain generators
+        :param validation_steps: number of validation batches, required for plain generators
+        :param callbacks: additional keras callbacks
+        """
+        seq_len = seq_len or getattr(train_data, "seq_len", None)
+        self.train_model = self._get_model(Phases.train, seq_shape=seq_len)
 
-        weights_path = os.path.join(self.output_folder, self.prefix + "weights.h5")
-        tensor_board = TensorBoard(log_dir=os.path.join(self.output_folder, "logs"), histogram_freq=1, write_images=True)
-        checkpoint = ModelCheckpoint(weights_path, save_best_only=True, verbose=1)
-        early_stop = EarlyStopping(patience=25, verbose=1)
+        weights_path = self._save_params()
+        # ModelCheckpoint and EarlyStopping monitor val_loss, fall back to loss without validation data
+        monitor = "val_loss" if validation_data is not None else "loss"
         try:
-            callbacks = [checkpoint, early_stop, tensor_board]
-            if self.monitor:
-                monitor = RemoteMonitor(root='http://localhost:9000')
-                callbacks = callbacks + [monitor]
-            self.train_model.fit(train_input, train_target, epochs=max_epochs, validation_data=(valid_input, [valid_target]), callbacks=callbacks)
+            self.train_model.fit_generator(train_data, steps_per_epoch=steps_per_epoch, epochs=max_epochs,
+                                           validation_data=validation_data, validation_steps=validation_steps,
+                                           callbacks=self._callbacks(weights_path, monitor=monitor, histograms=False,
+                                                                     extra_callbacks=callbacks),
+                                           workers=workers, use_multiprocessing=use_multiprocessing)
         except KeyboardInterrupt:
             logger.info("Training interrupted! Restoring best weights and saving..")
 
         # Reload the best weights
         self.train_model.load_weights(weights_path)
+        self.sync_predict_weights()
+
+    def fit_truncated(self, inputs, target, chunk_len=100, batch_size=32, max_epochs=10, validation_split=0.1,
+                      patience=25, initial_weights=None, callbacks=None):
+        """
+        Trains on long sequences with truncated backpropagation through time. Every batch of
+        sequences is fed in consecutive chunks of chunk_len steps to a stateful train model,
+        so the recurrent states are carried over from chunk to chunk and only reset at the
+        start of the next batch of sequences. The activation memory is bounded by chunk_len.
+        With a trending prior, the first step of a chunk gets the last z of the previous chunk
+        as z_{t-1}, only the first chunk of a sequence starts with noise like in fit.
+
+        The number of sequences of both splits is cut to a multiple of batch_size, as the
+        stateful model has a fixed batch size. The checkpoint, early stopping, TensorBoard and
+        timing callbacks are the ones of fit, every chunk counts as one batch.
+
+        :param inputs: the list of inputs [x_t, x_tm1] of shape (n_sequences, seq_len, data_dim)
+        :param target: the target x_t
+        :param chunk_len: the number of time steps per chunk and gradient update
+        :param batch_size: the number of sequences trained in parallel
+        :param patience: the epochs without improvement before training stops
+        :param callbacks: additional keras callbacks
+        """
+        n_sequences = target.shape[0]
+        seq_len = target.shape[1]
+        data_dim = target.shape[2]
+        assert self.data_dim == data_dim
+
+        # The last chunk of a sequence may be shorter, so the chunk length is left open
+        chunk_model = self._get_model(Phases.train, batch_size=batch_size, stateful=True)
+        if initial_weights:
+            chunk_model.load_weights(initial_weights)
+
+        list_in = inputs[:]
+        prior_input = None
+        if self.feeds_prior_input:
+            # The prior input is constant, one chunk of it is shared by all batches
+            prior_input = self.standard_prior_input(batch_size, chunk_len)
+
+        split_idx = int((1. - validation_split) * n_sequences)
+        train_batches = [slice(start, start + batch_size) for start in range(0, split_idx - batch_size + 1, batch_size)]
+        valid_batches = [slice(start, start + batch_size) for start in range(split_idx, n_sequences - batch_size + 1,
+                                                                              batch_size)]
+        if not train_batches:
+            raise ValueError("Not enough training sequences for a batch of %d!" % batch_size)
+        logger.info("Training on %d of %d sequences, validating on %d" % (
+            len(train_batches) * batch_size, split_idx, len(valid_batches) * batch_size))
+
+        weights_path = self._save_params()
+        # Monitor the training loss without validation sequences
+        monitor = "val_loss" if valid_batches else "loss"
+        callback_list = CallbackList(self._callbacks(weights_path, monitor=monitor, histograms=False, patience=patience,
+                                                     extra_callbacks=callbacks))
+        callback_list.set_model(chunk_model)
+        callback_list.set_params({"epochs": max_epochs, "batch_size": batch_size, "metrics": ["loss", "val_loss"]})
+
+        def run_chunks(batch, train, first_index=0):
+            # A new batch of sequences starts with new states
+            chunk_model.reset_states()
+            losses = []
+            for index, start in enumerate(range(0, seq_len, chunk_len)):
+                steps = slice(start, start + chunk_len)
+                chunk_in = [x[batch, steps] for x in list_in]
+                if prior_input is not None:
+                    chunk_in.append(prior_input[:, :chunk_in[0].shape[1]])
+                chunk_target = target[batch, steps]
+                if train:
+                    callback_list.on_batch_begin(first_index + index, {"batch": first_index + index,
+                                                                       "size": batch_size})
+                    losses.append(chunk_model.train_on_batch(chunk_in, chunk_target))
+                    callback_list.on_batch_end(first_index + index, {"batch": first_index + index, "size": batch_size,
+                                                                     "loss": losses[-1]})
+                else:
+                    losses.append(chunk_model.test_on_batch(chunk_in, chunk_target))
+            return np.mean(losses)
+
+        n_chunks = int(np.ceil(seq_len / float(chunk_len)))
+        chunk_model.stop_training = False
+        callback_list.on_train_begin()
+        try:
+            for epoch in range(max_epochs):
+                callback_list.on_epoch_begin(epoch)
+                start_time = time.time()
+                loss = np.mean([run_chunks(train_batches[i], train=True, first_index=n * n_chunks)
+                                for n, i in enumerate(np.random.permutation(len(train_batches)))])
+                logs = {"loss": loss}
+                if valid_batches:
+                    logs["val_loss"] = np.mean([run_chunks(batch, train=False) for batch in valid_batches])
+                logger.info("Epoch %d/%d - %.1fs - %s" % (epoch + 1, max_epochs, time.time() - start_time,
+                                                          " - ".join("%s: %.4f" % item for item in sorted(logs.items()))))
+
+                callback_list.on_epoch_end(epoch, logs)
+                if chunk_model.stop_training:
+                    break
+        except KeyboardInterrupt:
+            logger.info("Training interrupted! Restoring best weights and saving..")
+        callback_list.on_train_end()
+
+        # The stateless train model gets the best weights for the offline evaluation
+        self.train_model = self._get_model(Phases.train, seq_shape=seq_len)
+        self.train_model.load_weights(weights_path)
+        self.sync_predict_weights()
+
+    def _save_params(self):
+        with open(os.path.join(self.output_folder, self.prefix + "parameters.json"), "w") as f:
+            json.dump(self.get_params(), f, indent=4)
+
+        return os.path.join(self.output_folder, self.prefix + "weights.h5")
+
+    def _callbacks(self, weights_path, monitor="val_loss", histograms=True, patience=25, extra_callbacks=None):
+        checkpoint = TimedModelCheckpoint(weights_path, monitor=monitor, save_best_only=True, verbose=1)
+        early_stop = EarlyStopping(monitor=monitor, patience=patience, verbose=1)
+        callbacks = [checkpoint, early_stop]
+        if self.tensorboard:
+            # Histograms cannot be computed from validation generators
+            tensor_board_args = dict(log_dir=os.path.join(self.output_folder, "logs"),
+                                     histogram_freq=1 if histograms else 0, write_images=True)
+            if isinstance(self.tensorboard, dict):
+                tensor_board_args.update(self.tensorboard)
+            callbacks = callbacks + [TensorBoard(**tensor_board_args)]
+        if self.monitor:
+            monitor = RemoteMonitor(root='http://localhost:9000')
+            callbacks = callbacks + [monitor]
+        if self.timing_log:
+            callbacks = callbacks + [TimingCallback(self.timing_log, checkpoint=checkpoint)]
+        return callbacks + (extra_callbacks or [])
 
     def predict_one_step(self, inputs):
         n_sequences = inputs[0].shape[0]
@@ -237,18 +520,24 @@ class STORNModel(object):
         assert self.data_dim == data_dim
 
         list_in = inputs[:]
-        if not self.with_trending_prior:
-            list_in.append(STORNPriorModel.standard_input(n_sequences, seq_len, self.latent_dim, mode=self.rec))
-
-        _batch_size = 32
-        pred_inputs = [add_samples_until_divisible(input_x, _batch_size) for input_x in list_in]
+        if self.feeds_prior_input:
+            list_in.append(self.standard_prior_input(n_sequences, seq_len))
 
         # Build the predict model if necessary
         if self.predict_model is None:
-            self.predict_model = self._build(Phases.predict, batch_size=_batch_size)
-            self.load_predict_weights()
+            self.predict_model = self._get_model(Phases.predict, batch_size=32)
+            self.sync_predict_weights()
+        batch_size = self.predict_model.input_shape[0][0]
 
-        return self.predict_model.predict(pred_inputs, batch_size=_batch_size)[:n_sequences, :, :]
+        # Only a smaller last batch is padded, the predictions are written into one output array
+        predictions = None
+        for start, stop, batch in iter_batches(list_in, batch_size, pad_last=True):
+            prediction = self.predict_model.predict_on_batch(batch)
+            if predictions is None:
+                predictions = np.empty((n_sequences,) + prediction.shape[1:], dtype=prediction.dtype)
+            predictions[start:stop] = prediction[:stop - start]
+
+        return predictions
 
     def evaluate_offline(self, inputs, target):
         n_sequences = target.shape[0]
@@ -258,24 +547,64 @@ class STORNModel(object):
 
         # prepare inputs
         list_in = inputs[:]
-        if not self.with_trending_prior:
-            list_in.append(STORNPriorModel.standard_input(n_sequences, seq_len, self.latent_dim, mode=self.rec))
-
-        # prepare target
-        padded_target = np.concatenate(
-            (target, np.zeros((n_sequences, seq_len, 4 * self.latent_dim + data_dim))),
-            axis=-1)
+        if self.feeds_prior_input:
+            list_in.append(self.standard_prior_input(n_sequences, seq_len))
 
         # get predictions
         predictions = self.train_model.predict(list_in)
 
         # compute loss based on predictions
-        x = K.placeholder(ndim=3, dtype="float32")
-        stats = K.placeholder(ndim=3, dtype="float32")
-        get_loss = K.function(inputs=[x, stats], outputs=[keras_variational_func(self.data_dim, self.latent_dim, rec=self.rec)(x, stats)])
-        loss = get_loss([padded_target, predictions])
+        loss = self.get_loss_function()([target, predictions])
+        if self.masking:
+            loss[0] *= np.any(target != 0., axis=-1)
         return predictions[:, :, :data_dim], loss
 
+    def get_loss_function(self):
+        """
+        Compiles the per time step variational loss once per model instance.
+        The loss only reads the first data_dim features of the target, so the raw target can be fed.
+
+        :return: a backend function mapping [target, statistics] to a list with the loss
+                 of shape (n_sequences, seq_len)
+        """
+        if self._loss_function is None:
+            x = K.placeholder(ndim=3, dtype="float32")
+            stats = K.placeholder(ndim=3, dtype="float32")
+            loss = keras_variational_func(self.data_dim, self.latent_dim, rec=self.rec,
+                                          log_variance=self.log_variance)(x, stats)
+            self._loss_function = K.function(inputs=[x, stats], outputs=[loss])
+        return self._loss_function
+
+    def evaluate_monte_carlo(self, inputs, n_samples=10, batch_size=32):
+        """
+        Averages the loss over several latent samples. The recognition model runs once,
+        only the prior and generative branches are evaluated for each sample.
+
+        :param inputs: a list of inputs for the model, the first input x_t is also the target
+        :param n_samples: the number of latent samples per time step
+        :param batch_size: the number of sequences per forward pass
+        :return: the mean and the variance of the loss, both of shape (n_sequences, seq_len)
+        """
+        n_sequences = inputs[0].shape[0]
+        seq_len = inputs[0].shape[1]
+
+        list_in = inputs[:]
+        if self.feeds_prior_input:
+            list_in.append(self.standard_prior_input(n_sequences, seq_len))
+
+        if self._mc_samples != n_samples:
+            self._mc_model = self._build(Phases.train, mc_samples=n_samples)
+            self._mc_samples = n_samples
+        copy_weights(self.train_model, self._mc_model)
+
+        moments = self._mc_model.predict(list_in, batch_size=batch_size)
+        mean, variance = moments[:, :, 0], moments[:, :, 1]
+        if self.masking:
+            # Padded steps have no loss, like in evaluate_offline
+            steps = np.any(inputs[0] != 0., axis=-1)
+            mean, variance = mean * steps, variance * steps
+        return mean, variance
+
     def evaluate_online(self, inputs, ground_truth):
         """
         :param inputs: a list of inputs for the model. In this case, it's a
@@ -298,10 +627,51 @@ class STORNModel(object):
     def shift_z_output_shape(input_shape):
         return input_shape
 
+    @staticmethod
+    def tile_samples(x, n_samples):
+        return K.tile(x, (n_samples, 1, 1))
+
+    @staticmethod
+    def tile_samples_output_shape(input_shape):
+        return (None,) + tuple(input_shape[1:])
+
+    @staticmethod
+    def tile_samples_layer(n_samples):
+        return LambdaWithMasking(STORNModel.tile_samples, output_shape=STORNModel.tile_samples_output_shape,
+                                 mask_function=lambda x, mask: None if mask is None else K.tile(mask, (n_samples, 1)),
+                                 arguments={'n_samples': n_samples})
+
+    @staticmethod
+    def loss_moments(tensors, x_dim, latent_dim, rec, n_samples, log_variance=False):
+        x, output_statistics = tensors
+        loss = keras_variational_func(x_dim, latent_dim, rec=rec, log_variance=log_variance)(
+            STORNModel.tile_samples(x, n_samples), output_statistics)
+        # The samples were tiled along the batch axis
+        loss = K.reshape(loss, (n_samples, -1, K.shape(loss)[1]))
+        return K.stack([K.mean(loss, axis=0), K.var(loss, axis=0)], axis=-1)
+
+    @staticmethod
+    def loss_moments_output_shape(input_shapes):
+        return tuple(input_shapes[0][:2]) + (2,)
+
+
+def sigma_activation(log_variance):
+    # The log-variance is unbounded, the standard deviation has to be positive
+    return "linear" if log_variance else "softplus"
+
+
+def copy_weights(source, target):
+    """
+    Copies the weights between two STORN graphs by layer name.
+    """
+    for layer in target.layers:
+        if layer.weights:
+            layer.set_weights(source.get_layer(layer.name).get_weights())
+
 
 class STORNRecognitionModel(object):
     def __init__(self, data_dim, latent_dim, n_hidden_dense,
-                 n_hidden_recurrent, n_deep, dropout, activation, rec="gauss"):
+                 n_hidden_recurrent, n_deep, dropout, activation, rec="gauss", masking=False, log_variance=False):
         # Tensor shapes
         self.data_dim = data_dim
         self.latent_dim = latent_dim
@@ -313,6 +683,8 @@ class STORNRecognitionModel(object):
         self.dropout = dropout
         self.activation = activation
         self.rec = rec
+        self.masking = masking
+        self.log_variance = log_variance
 
         # Model states
         self.train_recogn_stats = None
@@ -323,14 +695,15 @@ class STORNRecognitionModel(object):
         self.predict_z_t = None
         self.rec_input = None
 
-    def _build(self, phase, seq_shape=None, batch_size=None, embedding=None):
+    def _build(self, phase, seq_shape=None, batch_size=None, embedding=None, n_samples=1, stateful=False):
         if phase == Phases.train:
-            x_t = Input(shape=(seq_shape, self.data_dim), name="stornREC_input_train", dtype="float32")
+            x_t = Input(batch_shape=(batch_size, seq_shape, self.data_dim), name="stornREC_input_train", dtype="float32")
         else:
             x_t = Input(batch_shape=(batch_size, 1, self.data_dim), name="stornREC_input_predict", dtype="float32")
 
-        # Unmasked Layer
         recogn_input = x_t
+        if self.masking:
+            recogn_input = Masking(mask_value=0.)(recogn_input)
 
         if embedding:
             recogn_input = embedding(recogn_input)
@@ -341,17 +714,23 @@ class STORNRecognitionModel(object):
                 recogn_input = Dropout(self.dropout)(recogn_input)
         self.rec_input = recogn_input
 
-        recogn_rnn = RecurrentLayer(self.n_hidden_recurrent, return_sequences=True, stateful=(phase == Phases.predict))(recogn_input)
+        recogn_rnn = RecurrentLayer(self.n_hidden_recurrent, return_sequences=True,
+                                    stateful=(phase == Phases.predict or stateful),
+                                    name="recognition_rnn")(recogn_input)
 
         recogn_map = recogn_rnn
         for i in range(self.n_deep):
-            recogn_map = TimeDistributed(Dense(self.n_hidden_dense, activation=self.activation))(recogn_map)
+            recogn_map = TimeDistributed(Dense(self.n_hidden_dense, activation=self.activation),
+                                         name="recognition_map_%d" % i)(recogn_map)
             if self.dropout != 0:
                 recogn_map = Dropout(self.dropout)(recogn_map)
 
         recogn_mu = TimeDistributed(Dense(self.latent_dim, activation='linear' if self.rec == "gauss" else "sigmoid"), name="recognition_mu")(recogn_map)
-        recogn_sigma = TimeDistributed(Dense(self.latent_dim, activation="softplus", name="recognition_sigma"))(recogn_map)
+        recogn_sigma = TimeDistributed(Dense(self.latent_dim, activation=sigma_activation(self.log_variance)),
+                                       name="recognition_sigma")(recogn_map)
         recogn_stats = Concatenate(axis=-1, name="recognition_stats")([recogn_mu, recogn_sigma])
+        if n_samples > 1:
+            recogn_stats = STORNModel.tile_samples_layer(n_samples)(recogn_stats)
 
         # sample z from the distribution in X
         z_t = TimeDistributed(LambdaWithMasking(STORNRecognitionModel.do_sample,
@@ -359,25 +738,32 @@ class STORNRecognitionModel(object):
                                                 arguments={
                                                     'batch_size': (None if (phase == Phases.train) else batch_size),
                                                     'dim_size': self.latent_dim,
-                                                    'mode': self.rec},
+                                                    'mode': self.rec,
+                                                    'log_variance': self.log_variance},
                                                 ))(recogn_stats)
 
         return recogn_stats, x_t, z_t
 
-    def build(self, phase=Phases.train, seq_shape=None, batch_size=None, embedding=None):
+    def build(self, phase=Phases.train, seq_shape=None, batch_size=None, embedding=None, n_samples=1, stateful=False):
         if phase == Phases.train:
+            # A stateful train model needs a fixed batch size, the stateless one takes any
             self.train_recogn_stats, self.train_input, self.train_z_t = self._build(Phases.train, 
-                                                                                    seq_shape=seq_shape, embedding=embedding)
+                                                                                    seq_shape=seq_shape,
+                                                                                    batch_size=batch_size if stateful else None,
+                                                                                    embedding=embedding,
+                                                                                    n_samples=n_samples, stateful=stateful)
         else:
             self.predict_recogn_stats, self.predict_input, self.predict_z_t = self._build(Phases.predict,
                                                                                           batch_size=batch_size,
                                                                                           embedding=embedding)
 
     @staticmethod
-    def do_sample(statistics, batch_size, dim_size, mode):
+    def do_sample(statistics, batch_size, dim_size, mode, log_variance=False):
         # split in half
         mu = statistics[:, :dim_size]
         sigma = statistics[:, dim_size:]
+        if log_variance:
+            sigma = K.exp(0.5 * clip_log_var(sigma))
 
         if batch_size is None:
             batch_size = K.shape(mu)[0]
@@ -396,7 +782,8 @@ class STORNRecognitionModel(object):
 
 
 class STORNPriorModel(object):
-    def __init__(self, latent_dim, trending, n_hidden_recurrent=None, x_tm1=None, z_tm1=None, rec="gauss"):
+    def __init__(self, latent_dim, trending, n_hidden_recurrent=None, x_tm1=None, z_tm1=None, rec="gauss", in_graph=False,
+                 log_variance=False):
         # Tensor shapes
         self.latent_dim = latent_dim
 
@@ -406,6 +793,8 @@ class STORNPriorModel(object):
 
         # STORN options
         self.trending = trending
+        self.in_graph = in_graph
+        self.log_variance = log_variance
 
         # Model states
         self.x_tm1 = x_tm1
@@ -415,41 +804,70 @@ class STORNPriorModel(object):
 
     def _build_std(self, phase, seq_shape=None, batch_size=None):
         if phase == Phases.train:
-            input_layer = Input(shape=(seq_shape, 2 * self.latent_dim),
+            input_layer = Input(batch_shape=(batch_size, seq_shape, 2 * self.latent_dim),
                                 name="storn_prior_input_train", dtype="float32")
         else:
             input_layer = Input(batch_shape=(batch_size, 1, 2 * self.latent_dim),
                                 name="storn_prior_input_predict", dtype="float32")
         return input_layer
 
-    def _build_trending(self, phase):
+    def _build_constant(self, phase, seq_shape=None):
+        # The input only determines the batch and time dimensions of the constant statistics
+        return LambdaWithMasking(STORNPriorModel.constant_stats,
+                                 output_shape=(seq_shape if phase == Phases.train else 1, 2 * self.latent_dim),
+                                 arguments={'latent_dim': self.latent_dim, 'mode': self.rec,
+                                            'log_variance': self.log_variance},
+                                 name="prior_stats")(self.x_tm1)
+
+    def _build_trending(self, phase, stateful=False):
         prior_input = Concatenate(axis=-1, name="prior_input")([self.x_tm1, self.z_tm1])
         rnn_prior = RecurrentLayer(self.n_hidden_recurrent,
                                    return_sequences=True,
-                                   stateful=(phase == Phases.predict))(
-            prior_input)
+                                   stateful=(phase == Phases.predict or stateful),
+                                   name="prior_rnn")(prior_input)
         rnn_rec_mu = TimeDistributed(Dense(self.latent_dim, activation='linear' if self.rec == "gauss" else "sigmoid"), name="prior_mu")(rnn_prior)
-        rnn_rec_sigma = TimeDistributed(Dense(self.latent_dim, activation="softplus"), name="prior_sigma")(rnn_prior)
+        rnn_rec_sigma = TimeDistributed(Dense(self.latent_dim, activation=sigma_activation(self.log_variance)),
+                                        name="prior_sigma")(rnn_prior)
 
         return Concatenate(axis=-1, name="prior_stats")([rnn_rec_mu, rnn_rec_sigma])
 
-    def build(self, phase=Phases.train, seq_shape=None, batch_size=None):
+    def build(self, phase=Phases.train, seq_shape=None, batch_size=None, stateful=False):
         if phase == Phases.train:
             if self.trending:
-                self.train_prior_stats = self._build_trending(phase)
+                self.train_prior_stats = self._build_trending(phase, stateful=stateful)
+            elif self.in_graph:
+                self.train_prior_stats = self._build_constant(phase, seq_shape=seq_shape)
             else:
-                self.train_prior_stats = self._build_std(phase, seq_shape=seq_shape)
+                self.train_prior_stats = self._build_std(phase, seq_shape=seq_shape,
+                                                         batch_size=batch_size if stateful else None)
         else:
             if self.trending:
                 self.predict_prior_stats = self._build_trending(phase)
+            elif self.in_graph:
+                self.predict_prior_stats = self._build_constant(phase)
             else:
                 self.predict_prior_stats = self._build_std(phase, batch_size=batch_size)
 
     @staticmethod
-    def standard_input(number_of_series, seq_len, latent_dim, mode="gauss"):
+    def constant_stats(x, latent_dim, mode, log_variance=False):
         if mode == "gauss":
-            sigma = np.ones(
-                (number_of_series, seq_len, latent_dim),
+            # A standard deviation of 1 is a log-variance of 0
+            mu, sigma = 0., 0. if log_variance else 1.
+        elif mode == "bernoulli":
+            mu, sigma = 0.5, 0.
+        else:
+            raise ValueError("Unknown mode!")
+
+        stats = np.concatenate([np.full(latent_dim, mu), np.full(latent_dim, sigma)]).astype("float32")
+        # Broadcast the statistics over the batch and time dimensions of x
+        return K.zeros_like(x[:, :, :1]) + K.constant(stats)
+
+    @staticmethod
+    def standard_input(number_of_series, seq_len, latent_dim, mode="gauss", log_variance=False):
+        if mode == "gauss":
+            # A standard deviation of 1 is a log-variance of 0
+            sigma = np.full(
+                (number_of_series, seq_len, latent_dim), 0. if log_variance else 1.,
                 dtype="float32"
             )
             my = np.zeros(
@@ -471,14 +889,89 @@ class STORNPriorModel(object):
         return np.concatenate([my, sigma], axis=-1)
 
 
-def run_storn_grid_search(inputs, target, test_inputs, test_target):
+class STORNSequence(Sequence):
+    """
+    Serves STORN training batches from an array of windows without loading it into memory.
+    The windows may be a memory-mapped numpy array or a HDF5 dataset of shape
+    (n_windows, seq_len + predict_forward, data_dim). The shifted x_t / x_tm1 pair and,
+    if the STORNModel feeds it, the standard prior input are generated per batch.
+    """
+
+    def __init__(self, windows, storn_model, batch_size=32, predict_forward=1, shuffle=True):
+        """
+        :param storn_model: the STORNModel the batches are for, it decides about the prior input
+        """
+        self.windows = windows
+        self.storn_model = storn_model
+        self.batch_size = batch_size
+        self.predict_forward = predict_forward
+        self.shuffle = shuffle
+
+        # Whole batches are shuffled, so every read stays a contiguous slice of the file
+        self.batch_order = np.arange(len(self))
+        if self.shuffle:
+            np.random.shuffle(self.batch_order)
+
+    @property
+    def seq_len(self):
+        return self.windows.shape[1] - self.predict_forward
+
+    def __len__(self):
+        return int(np.ceil(self.windows.shape[0] / float(self.batch_size)))
+
+    def _load_batch(self, idx):
+        start = self.batch_order[idx] * self.batch_size
+        return np.asarray(self.windows[start:start + self.batch_size], dtype="float32")
+
+    def __getitem__(self, idx):
+        batch = self._load_batch(idx)
+        x_tm1, x_t = generate_shifted(batch, predict_forward=self.predict_forward)
+
+        inputs = [x_t, x_tm1]
+        if self.storn_model.feeds_prior_input:
+            inputs.append(self.storn_model.standard_prior_input(batch.shape[0], x_t.shape[1]))
+        return inputs, x_t
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.batch_order)
+
+
+class BucketedSequence(STORNSequence):
+    """
+    Serves STORN training batches from sequences of different lengths. Sequences of similar
+    length are grouped into the same batch, which is only padded to its longest sequence.
+    Use it with a masking STORNModel, so the padded steps are skipped and ignored by the loss.
+    """
+
+    def __init__(self, sequences, storn_model, batch_size=32, **kwargs):
+        order = np.argsort([sequence.shape[0] for sequence in sequences], kind="mergesort")
+        self.batches = [order[start:start + batch_size] for start in range(0, len(sequences), batch_size)]
+        super(BucketedSequence, self).__init__(sequences, storn_model, batch_size=batch_size, **kwargs)
+
+    @property
+    def seq_len(self):
+        # The sequence length differs between the batches
+        return None
+
+    def __len__(self):
+        return len(self.batches)
+
+    def _load_batch(self, idx):
+        members = [self.windows[i] for i in self.batches[self.batch_order[idx]]]
+        return pad_sequences_3d(members, max(member.shape[0] for member in members))
+
+
+def run_storn_grid_search(inputs, target, test_inputs, test_target, log_file='results/grid_search/storn_grid.log',
+                          output_folder=None):
     """
     STORN is not compatible with the sklearn grid search, so we need
     to do a basic grid search ourselves.
     I'll use a standard holdout instead of cross validation, since
     cross validation is very expensive (STORN trains slowly).
+    For a parallel search with early abandoning see greenarm.models.grid_search.storn_search.
     """
-    hdlr = logging.FileHandler('results/grid_search/storn_grid.log')
+    hdlr = logging.FileHandler(log_file)
     formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
     hdlr.setFormatter(formatter)
     logger.addHandler(hdlr)
@@ -489,7 +982,8 @@ def run_storn_grid_search(inputs, target, test_inputs, test_target):
     for n_deep in deep:
         for latent_dim in latent:
             storn = STORNModel(activation='tanh', n_deep=n_deep, with_trending_prior=True, latent_dim=latent_dim,
-                               n_hidden_dense=64)
+                               n_hidden_dense=64, output_folder=output_folder,
+                               prefix="deep%d_latent%d_" % (n_deep, latent_dim))
             storn.fit(inputs, target, max_epochs=600)
             _, err = storn.evaluate_offline(test_inputs, test_target)
             logger.info("deep: %d, latent: %d, loss: %f" % (n_deep, latent_dim, np.mean(err)))
@@ -0,0 +1,93 @@
+"""
+Lightweight training instrumentation.
+"""
+import json
+import time
+
+from keras.callbacks import Callback, ModelCheckpoint
+from greenarm.util import get_logger
+
+logger = get_logger(__name__)
+
+
+class TimedModelCheckpoint(ModelCheckpoint):
+    """
+    A ModelCheckpoint that measures how long writing the checkpoint takes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedModelCheckpoint, self).__init__(*args, **kwargs)
+        self.write_time = 0.
+
+    def on_epoch_end(self, epoch, logs=None):
+        start = time.time()
+        super(TimedModelCheckpoint, self).on_epoch_end(epoch, logs)
+        self.write_time = time.time() - start
+
+
+class TimingCallback(Callback):
+    """
+    Records the step time, the time between two steps and the throughput of every batch,
+    and the checkpoint writing time of every epoch. The time between two steps includes
+    the data feeding and the batch hooks of all other callbacks.
+    The records are written as JSON lines, or logged if no file is given.
+    Has to be placed after the checkpoint in the callback list.
+    """
+
+    def __init__(self, log_file=None, checkpoint=None):
+        super(TimingCallback, self).__init__()
+        self.log_file = log_file
+        self.checkpoint = checkpoint
+
+        # Object state
+        self._file = None
+        self._epoch = 0
+        self._batch_start = None
+        self._batch_end = None
+        self._epoch_start = None
+        self._epoch_samples = 0
+
+    def _record(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+        else:
+            logger.info(json.dumps(record))
+
+    def on_train_begin(self, logs=None):
+        if self.log_file:
+            self._file = open(self.log_file, "a")
+
+    def on_train_end(self, logs=None):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+        self._epoch_start = time.time()
+        self._epoch_samples = 0
+        self._batch_end = None
+
+    def on_batch_begin(self, batch, logs=None):
+        self._batch_start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        now = time.time()
+        step_time = now - self._batch_start
+        between_time = self._batch_start - self._batch_end if self._batch_end is not None else 0.
+        size = (logs or {}).get("size", 0)
+        self._epoch_samples += size
+        self._batch_end = now
+
+        self._record({"epoch": self._epoch, "batch": batch, "step_s": step_time, "between_batches_s": between_time,
+                      "samples_per_s": size / step_time if step_time > 0 else None})
+
+    def on_epoch_end(self, epoch, logs=None):
+        duration = time.time() - self._epoch_start
+        record = {"epoch": epoch, "epoch_s": duration,
+                  "samples_per_s": self._epoch_samples / duration if duration > 0 else None}
+        if self.checkpoint is not None:
+            record["checkpoint_s"] = self.checkpoint.write_time
+        self._record(record)
+        if self._file is not None:
+            self._file.flush()
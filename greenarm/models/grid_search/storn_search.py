@@ -0,0 +1,159 @@
+"""
+Parallel hyper-parameter search for STORN with successive halving.
+
+Every trial trains in its own folder inside a pool of worker processes. After each
+rung only the best 1/reduction_factor of the trials continue training from their
+best weights, the others are abandoned. All results are appended to a ledger, so an
+interrupted search resumes where it stopped. Results and weights are kept by the total
+epochs of their rung, so a search with another epoch schedule does not reuse them.
+"""
+import itertools
+import json
+import math
+import multiprocessing
+import os
+
+import numpy as np
+
+from greenarm.util import get_logger
+
+logger = get_logger(__name__)
+
+# Training data of the worker processes, set once per worker by _init_worker
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _train_trial(trial):
+    # Keras is imported in the workers only, so every process has its own backend session
+    import keras.backend as K
+    from greenarm.models.STORN import STORNModel
+
+    inputs, target, valid_inputs, valid_target = _worker_data
+    K.clear_session()
+
+    storn = STORNModel(output_folder=trial["folder"], **dict(trial["params"], prefix=trial["prefix"]))
+    storn.fit(inputs, target, max_epochs=trial["epochs"], initial_weights=trial["initial_weights"])
+    _, loss = storn.evaluate_offline(valid_inputs, valid_target)
+
+    return dict(trial_id=trial["trial_id"], params=trial["params"], rung=trial["rung"],
+                epochs=trial["total_epochs"], loss=float(np.mean(loss)))
+
+
+class STORNSearch(object):
+    def __init__(self, param_grid, output_folder, base_params=None, n_workers=2, min_epochs=25, max_epochs=600,
+                 reduction_factor=3):
+        """
+        :param param_grid: a dict mapping STORNModel parameters to the list of values to try
+        :param output_folder: the folder for the trial folders and the ledger
+        :param base_params: STORNModel parameters shared by all trials
+        :param n_workers: the number of trials trained in parallel
+        :param min_epochs: the epochs every trial trains in the first rung
+        :param max_epochs: the epochs of the trials that survive all rungs
+        :param reduction_factor: the factor the trials are reduced and the epochs increased by per rung
+        """
+        self.param_grid = param_grid
+        self.output_folder = output_folder
+        self.base_params = base_params or {}
+        self.n_workers = n_workers
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.reduction_factor = reduction_factor
+
+        self.ledger_path = os.path.join(output_folder, "ledger.jsonl")
+
+    def trials(self):
+        names = sorted(self.param_grid)
+        trials = {}
+        for values in itertools.product(*[self.param_grid[name] for name in names]):
+            params = dict(zip(names, values))
+            trial_id = "_".join("%s-%s" % (name, value) for name, value in zip(names, values))
+            trials[trial_id] = dict(self.base_params, **params)
+        return trials
+
+    def rungs(self):
+        rungs = []
+        epochs = self.min_epochs
+        while epochs < self.max_epochs:
+            rungs.append(int(epochs))
+            epochs *= self.reduction_factor
+        return rungs + [self.max_epochs]
+
+    def read_ledger(self):
+        results = {}
+        if os.path.exists(self.ledger_path):
+            with open(self.ledger_path, "r") as f:
+                for line in f:
+                    result = json.loads(line)
+                    results[(result["trial_id"], result["rung"], result["epochs"])] = result
+        return results
+
+    def run(self, inputs, target, valid_inputs, valid_target):
+        """
+        Runs the search, continuing the results of the ledger.
+
+        :return: the results of the last rung every trial reached, ranked by validation loss
+        """
+        if not os.path.exists(self.output_folder):
+            os.makedirs(self.output_folder)
+
+        trials = self.trials()
+        ledger = self.read_ledger()
+        best = {}
+        surviving = sorted(trials)
+        previous_epochs = 0
+
+        # Forking a parent that has already initialised the backend can deadlock the workers,
+        # Python 2 has no start methods and always forks
+        context = multiprocessing.get_context("spawn") if hasattr(multiprocessing, "get_context") else multiprocessing
+        pool = context.Pool(self.n_workers, initializer=_init_worker,
+                            initargs=((inputs, target, valid_inputs, valid_target),))
+        try:
+            for rung, epochs in enumerate(self.rungs()):
+                pending = []
+                for trial_id in surviving:
+                    if (trial_id, rung, epochs) in ledger:
+                        continue
+
+                    folder = os.path.join(self.output_folder, trial_id)
+                    if not os.path.exists(folder):
+                        os.makedirs(folder)
+                    # Every rung continues from the best weights of the previous rung
+                    weights = os.path.join(folder, "epochs%d_weights.h5" % previous_epochs)
+                    pending.append(dict(trial_id=trial_id, params=trials[trial_id], rung=rung, folder=folder,
+                                        prefix="epochs%d_" % epochs, epochs=epochs - previous_epochs,
+                                        total_epochs=epochs, initial_weights=weights if rung > 0 else None))
+
+                logger.info("Rung %d: training %d of %d trials for %d epochs" % (
+                    rung, len(pending), len(surviving), epochs))
+                with open(self.ledger_path, "a") as f:
+                    for result in pool.imap_unordered(_train_trial, pending):
+                        ledger[(result["trial_id"], rung, epochs)] = result
+                        f.write(json.dumps(result) + "\n")
+                        f.flush()
+                        logger.info("Trial %s, rung %d: loss %f" % (result["trial_id"], rung, result["loss"]))
+
+                for trial_id in surviving:
+                    best[trial_id] = ledger[(trial_id, rung, epochs)]
+
+                # Abandon the worst trials
+                surviving = sorted(surviving, key=lambda t: ledger[(t, rung, epochs)]["loss"])
+                surviving = surviving[:int(math.ceil(len(surviving) / float(self.reduction_factor)))]
+                previous_epochs = epochs
+        finally:
+            pool.close()
+            pool.join()
+
+        ranking = sorted(best.values(), key=lambda result: (-result["rung"], result["loss"]))
+        self.log_ranking(ranking)
+        return ranking
+
+    @staticmethod
+    def log_ranking(ranking):
+        logger.info("%4s %10s %6s  %s" % ("rank", "loss", "epochs", "trial"))
+        for rank, result in enumerate(ranking):
+            logger.info("%4d %10.4f %6d  %s" % (rank + 1, result["loss"], result["epochs"], result["trial_id"]))
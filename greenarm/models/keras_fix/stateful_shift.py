@@ -0,0 +1,38 @@
+from keras.engine import Layer
+from keras import backend as K
+
+
+class StatefulShift(Layer):
+    '''Shifts a sequence of latent samples one step forward in time, like STORNModel.shift_z.
+    The first step takes the last sample of the previous batch instead of noise, so a
+    sequence fed in consecutive chunks sees z_{t-1} across the chunk boundaries. Only the
+    first chunk after reset_states starts with noise.
+    # Input shape
+        3D tensor with a fixed batch size, (batch_size, timesteps, latent_dim).
+    # Output shape
+        Same as the input shape.
+    '''
+
+    def __init__(self, **kwargs):
+        super(StatefulShift, self).__init__(**kwargs)
+        self.supports_masking = True
+        self.stateful = True
+
+    def build(self, input_shape):
+        if input_shape[0] is None:
+            raise ValueError("StatefulShift needs a fixed batch size!")
+        self.last_z = K.zeros((input_shape[0], 1, input_shape[2]))
+        self.started = K.variable(0.)
+        super(StatefulShift, self).build(input_shape)
+
+    def call(self, inputs, mask=None):
+        noise = K.random_normal(shape=K.int_shape(self.last_z))
+        first = self.started * self.last_z + (1. - self.started) * noise
+        self.add_update([K.update(self.last_z, inputs[:, -1:, :]), K.update(self.started, 1.)], inputs)
+        return K.concatenate((first, inputs[:, :-1, :]), axis=1)
+
+    def compute_mask(self, inputs, mask=None):
+        return mask
+
+    def reset_states(self):
+        K.set_value(self.started, 0.)
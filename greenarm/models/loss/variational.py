@@ -4,6 +4,21 @@ TODO: define the log likelihood upper bound for variational bayes in here
 import numpy as np
 import keras.backend as K
 
+LOG_2PI = np.log(2 * np.pi)
+# The log-variances are clipped to +-LOG_VAR_LIMIT before they are exponentiated, so a
+# diverging head yields a large but finite loss instead of inf or nan
+LOG_VAR_LIMIT = 30.
+
+
+def _dim(x):
+    """
+    The size of the last dimension as a python number if it is known, else as a tensor.
+    """
+    dim = K.int_shape(x)[-1]
+    if dim is None:
+        dim = K.cast(K.shape(x)[-1], K.dtype(x))
+    return dim
+
 
 def divergence(mu1, sigma1, mu2=0, sigma2=1):
     """
@@ -27,9 +42,10 @@ def divergence(mu1, sigma1, mu2=0, sigma2=1):
     in the data batch, elements in the sequence) to make every point equally
     important.
     """
+    # The constant -0.5 per component is added once after the sum
     term = K.sum(K.log(sigma2 / sigma1) +
-                 ((K.square(sigma1) + K.square(mu1 - mu2)) / (2 * K.square(sigma2))) - 0.5, axis=-1)
-    return term
+                 (K.square(sigma1) + K.square(mu1 - mu2)) / (2 * K.square(sigma2)), axis=-1)
+    return term - 0.5 * _dim(mu1)
 
 
 def gauss(x, mu, sigma):
@@ -53,9 +69,32 @@ def gauss(x, mu, sigma):
     in the data batch, elements in the sequence) to make every point equally
     important.
     """
-    nll = 0.5 * K.sum(K.square(x - mu) / K.square(sigma) + 2 * K.log(sigma) +
-                      K.log(2 * np.pi), axis=-1)
-    return nll
+    # The normalization constant 0.5 * log(2 pi) per component is added once after the sum
+    nll = K.sum(0.5 * K.square((x - mu) / sigma) + K.log(sigma), axis=-1)
+    return nll + 0.5 * LOG_2PI * _dim(x)
+
+
+def clip_log_var(log_var):
+    return K.clip(log_var, -LOG_VAR_LIMIT, LOG_VAR_LIMIT)
+
+
+def divergence_log_var(mu1, log_var1, mu2, log_var2):
+    """
+    Like divergence, but with both gaussians given by their mean and log-variance.
+    Neither the logarithm nor a division of a standard deviation is needed.
+    """
+    log_var1, log_var2 = clip_log_var(log_var1), clip_log_var(log_var2)
+    term = 0.5 * K.sum(log_var2 - log_var1 + (K.exp(log_var1) + K.square(mu1 - mu2)) * K.exp(-log_var2), axis=-1)
+    return term - 0.5 * _dim(mu1)
+
+
+def gauss_log_var(x, mu, log_var):
+    """
+    Like gauss, but with the gaussian given by its mean and log-variance.
+    """
+    log_var = clip_log_var(log_var)
+    nll = 0.5 * K.sum(K.square(x - mu) * K.exp(-log_var) + log_var, axis=-1)
+    return nll + 0.5 * LOG_2PI * _dim(x)
 
 
 def keras_divergence(x, output_statistics):
@@ -84,7 +123,7 @@ def keras_gauss_func(x_dim):
 
     return keras_gauss
 
-def keras_variational_func(x_dim, latent_dim, rec="gauss"):
+def keras_variational_func(x_dim, latent_dim, rec="gauss", log_variance=False):
     def keras_variational(x, output_statistics):
         """
         A wrapper around the variational upper bound loss for keras.
@@ -94,6 +133,7 @@ def keras_variational_func(x_dim, latent_dim, rec="gauss"):
                 generating and recognition model. First third is the generating model's
                 mu and sigma, second third is the recognition model's mu and sigma.
                 The last third represents the mu and sigma of the trending prior.
+                With log_variance, the log-variances take the place of the sigmas.
         :return: the keras loss tensor
         """
         
@@ -106,10 +146,13 @@ def keras_variational_func(x_dim, latent_dim, rec="gauss"):
         encoder_sigma = output_statistics[:, :, 2 * x_dim + latent_dim:2 * x_dim + 2 * latent_dim]
         prior_mu = output_statistics[:, :, 2 * x_dim + 2 * latent_dim: 2 * x_dim + 3 * latent_dim]
         prior_sigma = output_statistics[:, :, 2 * x_dim + 3 * latent_dim:]
-        if rec == "gauss":
+        if rec == "gauss" and log_variance:
+            # The log-variances are the sigma slices
+            expect_term = gauss_log_var(x_stripped, gen_mu, gen_sigma)
+            kl_term = divergence_log_var(encoder_mu, encoder_sigma, prior_mu, prior_sigma)
+        elif rec == "gauss":
             expect_term = gauss(x_stripped, gen_mu, gen_sigma)
-            kl_term = divergence(encoder_mu, encoder_sigma,
-                                prior_mu, prior_sigma)
+            kl_term = divergence(encoder_mu, encoder_sigma, prior_mu, prior_sigma)
         elif rec == "bernoulli":
             expect_term = bernoulli(x_stripped, gen_mu, gen_sigma)
             # Encoder mu and prior mu are actually the learned probabilities
@@ -0,0 +1,367 @@
+"""
+Keras-free inference for trained STORN models.
+
+The weights of a STORNModel are exported to a .npz archive which NumpySTORN
+runs with plain NumPy, one time step per call, like the stateful predict model.
+The weights can be exported with reduced precision, as float16 or as int8 with one
+scale per output unit, which shrinks the archives and the memory of the scorers.
+"""
+import json
+
+import numpy as np
+
+# Same as greenarm.models.loss.variational.LOG_VAR_LIMIT
+LOG_VAR_LIMIT = 30.
+
+
+def _hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0., 1.)
+
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "tanh": np.tanh,
+    "sigmoid": _sigmoid,
+    "hard_sigmoid": _hard_sigmoid,
+    "relu": lambda x: np.maximum(x, 0.),
+    "softplus": lambda x: np.logaddexp(0., x),
+    "softsign": lambda x: x / (1. + np.abs(x)),
+    "elu": lambda x: np.where(x > 0., x, np.expm1(x)),
+}
+
+
+def gauss(x, mu, sigma):
+    """
+    NumPy version of greenarm.models.loss.variational.gauss
+    """
+    return np.sum(0.5 * np.square((x - mu) / sigma) + np.log(sigma), axis=-1) + 0.5 * np.log(2 * np.pi) * x.shape[-1]
+
+
+def divergence(mu1, sigma1, mu2, sigma2):
+    """
+    NumPy version of greenarm.models.loss.variational.divergence
+    """
+    return np.sum(np.log(sigma2 / sigma1) +
+                  (np.square(sigma1) + np.square(mu1 - mu2)) / (2 * np.square(sigma2)), axis=-1) - 0.5 * mu1.shape[-1]
+
+
+def gauss_log_var(x, mu, log_var):
+    """
+    NumPy version of greenarm.models.loss.variational.gauss_log_var
+    """
+    log_var = np.clip(log_var, -LOG_VAR_LIMIT, LOG_VAR_LIMIT)
+    return 0.5 * np.sum(np.square(x - mu) * np.exp(-log_var) + log_var, axis=-1) + \
+        0.5 * np.log(2 * np.pi) * x.shape[-1]
+
+
+def divergence_log_var(mu1, log_var1, mu2, log_var2):
+    """
+    NumPy version of greenarm.models.loss.variational.divergence_log_var
+    """
+    log_var1 = np.clip(log_var1, -LOG_VAR_LIMIT, LOG_VAR_LIMIT)
+    log_var2 = np.clip(log_var2, -LOG_VAR_LIMIT, LOG_VAR_LIMIT)
+    return 0.5 * np.sum(log_var2 - log_var1 + (np.exp(log_var1) + np.square(mu1 - mu2)) * np.exp(-log_var2),
+                        axis=-1) - 0.5 * mu1.shape[-1]
+
+
+def variational_loss(x, gen_mu, gen_sigma, encoder_mu, encoder_sigma, prior_mu, prior_sigma, rec="gauss",
+                     log_variance=False):
+    """
+    NumPy version of the loss of greenarm.models.loss.variational.keras_variational_func
+    """
+    if rec == "gauss" and log_variance:
+        return gauss_log_var(x, gen_mu, gen_sigma) + divergence_log_var(encoder_mu, encoder_sigma, prior_mu, prior_sigma)
+    elif rec == "gauss":
+        return gauss(x, gen_mu, gen_sigma) + divergence(encoder_mu, encoder_sigma, prior_mu, prior_sigma)
+    elif rec == "bernoulli":
+        expect_term = np.sum(x * gen_mu + (1. - x) * (1. - gen_mu), axis=-1)
+        return expect_term + np.mean(np.square(encoder_mu - prior_mu), axis=-1)
+    else:
+        raise ValueError("Unknown rec function!")
+
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+def quantize(weights, precision="float32"):
+    """
+    Converts float32 weights to the given precision. Kernels are quantized to int8 with a
+    symmetric float32 scale per output unit, the biases stay float32.
+
+    :return: the converted arrays, int8 kernels come with a "<name>/scale" array
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision %s!" % precision)
+
+    arrays = {}
+    for name, value in weights.items():
+        if precision == "int8" and name.endswith("kernel"):
+            scale = np.max(np.abs(value), axis=0) / 127.
+            scale[scale == 0.] = 1.
+            arrays[name] = np.round(value / scale).astype("int8")
+            arrays[name + "/scale"] = scale.astype("float32")
+        elif precision == "float16":
+            arrays[name] = value.astype("float16")
+        else:
+            arrays[name] = value.astype("float32")
+    return arrays
+
+
+def dequantize(arrays, dtype="float32"):
+    """
+    Converts weights produced by quantize to the compute dtype.
+    """
+    weights = {}
+    for name, value in arrays.items():
+        if name.endswith("/scale"):
+            continue
+        if name + "/scale" in arrays:
+            value = value * arrays[name + "/scale"]
+        weights[name] = value.astype(dtype)
+    return weights
+
+
+def export_weights(storn_model, path, precision="float32"):
+    """
+    Exports the weights of a STORNModel into a .npz archive that can be loaded by NumpySTORN.
+
+    :param storn_model: a built STORNModel, the predict model is exported if available
+    :param path: the path of the archive
+    :param precision: the precision of the stored weights, one of PRECISIONS
+    """
+    if storn_model.embedding:
+        raise ValueError("Models with an embedding cannot be exported!")
+
+    model = storn_model.predict_model if storn_model.predict_model is not None else storn_model.train_model
+    arrays = {}
+    activations = {}
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if not weights:
+            continue
+
+        # Unwrap the TimeDistributed layers
+        inner = getattr(layer, "layer", layer)
+        if hasattr(inner, "recurrent_activation"):
+            weight_names = ("kernel", "recurrent_kernel", "bias")
+            activations[layer.name] = [inner.activation.__name__, inner.recurrent_activation.__name__]
+        else:
+            weight_names = ("kernel", "bias")
+            activations[layer.name] = [inner.activation.__name__]
+
+        for weight_name, value in zip(weight_names, weights):
+            arrays[layer.name + "/" + weight_name] = value
+
+    config = {
+        "data_dim": storn_model.data_dim,
+        "latent_dim": storn_model.latent_dim,
+        "n_deep": storn_model.n_deep,
+        "rec": storn_model.rec,
+        "with_trending_prior": storn_model.with_trending_prior,
+        "masking": storn_model.masking,
+        "log_variance": storn_model.log_variance,
+        "precision": precision,
+        "activations": activations
+    }
+    np.savez(path, config=np.array(json.dumps(config)), **quantize(arrays, precision))
+
+
+class NumpySTORN(object):
+    """
+    Runs the STORN predict model with NumPy only. Like the stateful predict model,
+    the recurrent states are kept between the calls of step until reset is called.
+
+    The network runs in the given compute dtype, the loss is always computed in float32.
+    NumPy has no BLAS kernels for float16, so float16 computation saves memory, not time.
+    """
+
+    def __init__(self, config, weights, seed=None, dtype="float32"):
+        self.data_dim = config["data_dim"]
+        self.latent_dim = config["latent_dim"]
+        self.n_deep = config["n_deep"]
+        self.rec = config["rec"]
+        self.with_trending_prior = config["with_trending_prior"]
+        self.masking = config.get("masking", False)
+        self.log_variance = config.get("log_variance", False)
+        self.activations = config["activations"]
+        self.dtype = np.dtype(dtype)
+        self.weights = {name: value.astype(self.dtype, copy=False) for name, value in weights.items()}
+        self.random = np.random.RandomState(seed)
+
+        # Object state
+        self.states = {}
+        self.x_tm1 = None
+        self._step_mask = None
+
+    @classmethod
+    def load(cls, path, seed=None, dtype="float32"):
+        with np.load(path) as archive:
+            config = json.loads(archive["config"].item())
+            weights = dequantize({name: archive[name] for name in archive.files if name != "config"}, dtype)
+
+        return cls(config, weights, seed=seed, dtype=dtype)
+
+    def reset(self):
+        """
+        Resets the recurrent states and the previous samples of all streams.
+        """
+        self.states = {}
+        self.x_tm1 = None
+
+    def _dense(self, name, x):
+        y = np.dot(x, self.weights[name + "/kernel"]) + self.weights[name + "/bias"]
+        return ACTIVATIONS[self.activations[name][0]](y)
+
+    def _rnn(self, name, x):
+        kernel = self.weights[name + "/kernel"]
+        recurrent_kernel = self.weights[name + "/recurrent_kernel"]
+        bias = self.weights[name + "/bias"]
+        activation, recurrent_activation = [ACTIVATIONS[a] for a in self.activations[name]]
+        units = recurrent_kernel.shape[0]
+
+        if name not in self.states:
+            self.states[name] = (np.zeros((x.shape[0], units), dtype=x.dtype),
+                                 np.zeros((x.shape[0], units), dtype=x.dtype))
+        h, c = self.states[name]
+
+        # Keras orders the LSTM gates as input, forget, cell and output gate
+        z = np.dot(x, kernel) + np.dot(h, recurrent_kernel) + bias
+        i = recurrent_activation(z[:, :units])
+        f = recurrent_activation(z[:, units:2 * units])
+        c = f * c + i * activation(z[:, 2 * units:3 * units])
+        h = recurrent_activation(z[:, 3 * units:]) * activation(c)
+
+        # Masked (all-zero) samples keep the previous states, like the masked keras LSTM
+        if self._step_mask is not None:
+            h = np.where(self._step_mask, h, self.states[name][0])
+            c = np.where(self._step_mask, c, self.states[name][1])
+
+        self.states[name] = (h, c)
+        return h
+
+    def _sample(self, mu, sigma):
+        if self.rec == "gauss":
+            if self.log_variance:
+                sigma = np.exp(0.5 * np.clip(sigma, -LOG_VAR_LIMIT, LOG_VAR_LIMIT))
+            return mu + sigma * self.random.standard_normal(mu.shape).astype(mu.dtype)
+        elif self.rec == "bernoulli":
+            return (self.random.uniform(size=mu.shape) < mu).astype(mu.dtype)
+
+    def statistics(self, x_t, x_tm1):
+        """
+        Runs one time step of the predict model.
+
+        :param x_t: the current samples, shape (n_streams, data_dim)
+        :param x_tm1: the previous samples, shape (n_streams, data_dim)
+        :return: gen_mu, gen_sigma, encoder_mu, encoder_sigma, prior_mu, prior_sigma
+        """
+        if self.masking:
+            self._step_mask = np.any(x_t != 0., axis=-1)[:, None]
+
+        # Recognition model
+        recogn_map = self._rnn("recognition_rnn", x_t)
+        for i in range(self.n_deep):
+            recogn_map = self._dense("recognition_map_%d" % i, recogn_map)
+        encoder_mu = self._dense("recognition_mu", recogn_map)
+        encoder_sigma = self._dense("recognition_sigma", recogn_map)
+        z_t = self._sample(encoder_mu, encoder_sigma)
+
+        # Prior model
+        if self.with_trending_prior:
+            # With a single time step per call, the shifted z of the predict model is always noise
+            z_tm1 = self.random.standard_normal(z_t.shape).astype(z_t.dtype)
+            rnn_prior = self._rnn("prior_rnn", np.concatenate([x_tm1, z_tm1], axis=-1))
+            prior_mu = self._dense("prior_mu", rnn_prior)
+            prior_sigma = self._dense("prior_sigma", rnn_prior)
+        elif self.rec == "gauss":
+            prior_mu = np.zeros_like(encoder_mu)
+            prior_sigma = np.zeros_like(encoder_sigma) if self.log_variance else np.ones_like(encoder_sigma)
+        else:
+            prior_mu, prior_sigma = np.full_like(encoder_mu, 0.5), np.zeros_like(encoder_sigma)
+
+        # Generative model
+        gen_input = np.concatenate([x_tm1, z_t], axis=-1)
+        for i in range(self.n_deep):
+            gen_input = self._dense("generative_input_%d" % i, gen_input)
+        gen_map = self._rnn("generative_rnn", gen_input)
+        for i in range(self.n_deep):
+            gen_map = self._dense("generative_map_%d" % i, gen_map)
+        gen_mu = self._dense("generative_mu", gen_map)
+        gen_sigma = self._dense("generative_sigma", gen_map)
+
+        return gen_mu, gen_sigma, encoder_mu, encoder_sigma, prior_mu, prior_sigma
+
+    def step(self, x_t):
+        """
+        Scores a single time step, the previous samples are remembered from the last call.
+
+        :param x_t: the current sample of every stream, shape (n_streams, data_dim)
+        :return: the variational loss (NLL + KL) of every stream, shape (n_streams,)
+        """
+        x_t = np.asarray(x_t, dtype=self.dtype)
+        if self.x_tm1 is None:
+            self.x_tm1 = np.zeros_like(x_t)
+
+        loss = self._loss(x_t, self.statistics(x_t, self.x_tm1))
+        self.x_tm1 = x_t
+        return loss
+
+    def score(self, x_t, x_tm1):
+        """
+        Scores whole sequences step by step, starting from reset states.
+
+        :param x_t: the current samples, shape (n_sequences, seq_len, data_dim)
+        :param x_tm1: the previous samples, shape (n_sequences, seq_len, data_dim)
+        :return: the variational loss of shape (n_sequences, seq_len)
+        """
+        x_t = np.asarray(x_t, dtype=self.dtype)
+        x_tm1 = np.asarray(x_tm1, dtype=self.dtype)
+
+        self.reset()
+        loss = np.empty(x_t.shape[:2], dtype="float32")
+        for t in range(x_t.shape[1]):
+            loss[:, t] = self._loss(x_t[:, t], self.statistics(x_t[:, t], x_tm1[:, t]))
+        self.reset()
+        return loss
+
+    def _loss(self, x_t, statistics):
+        # float16 statistics overflow in the squares of the loss
+        return variational_loss(x_t.astype("float32"), *[s.astype("float32") for s in statistics], rec=self.rec,
+                                log_variance=self.log_variance)
+
+
+def accuracy_report(path, x_t, x_tm1, precisions=("float16", "int8"), dtype="float32", seed=0):
+    """
+    Compares the loss of reduced precision weights against the float32 weights of an archive.
+    All runs draw the same latent samples, so the differences are caused by the precision only.
+
+    :param path: an archive exported with float32 precision
+    :param x_t: the current samples, shape (n_sequences, seq_len, data_dim)
+    :param x_tm1: the previous samples, shape (n_sequences, seq_len, data_dim)
+    :param precisions: the precisions to compare
+    :param dtype: the compute dtype of the reduced precision runs
+    :return: a dict with the absolute and relative loss errors and the weight bytes per precision
+    """
+    with np.load(path) as archive:
+        config = json.loads(archive["config"].item())
+        weights = {name: archive[name] for name in archive.files if name != "config"}
+    if config.get("precision", "float32") != "float32":
+        raise ValueError("The reference archive has to be exported with float32 precision!")
+
+    reference = NumpySTORN(config, weights, seed=seed).score(x_t, x_tm1)
+    report = {"float32": {"weight_bytes": sum(w.nbytes for w in weights.values())}}
+    for precision in precisions:
+        arrays = quantize(weights, precision)
+        loss = NumpySTORN(config, dequantize(arrays, dtype), seed=seed, dtype=dtype).score(x_t, x_tm1)
+        error = np.abs(loss - reference)
+        report[precision] = {
+            "weight_bytes": sum(a.nbytes for a in arrays.values()),
+            "mean_abs_error": float(np.mean(error)),
+            "max_abs_error": float(np.max(error)),
+            "mean_rel_error": float(np.mean(error / np.maximum(np.abs(reference), 1e-6)))
+        }
+    return report
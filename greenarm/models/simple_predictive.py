@@ -92,8 +92,8 @@ class TimeSeriesPredictor(object):
         self.predict_model = self._build_model(batch_size=batch_size, phase="predict")
 
     def load_predict_weights(self):
-        self.train_model.save_weights("tmp_weights.h5", overwrite=True)
-        self.predict_model.load_weights("tmp_weights.h5")
+        # Both models have the same layers, so the weights can be copied in memory
+        self.predict_model.set_weights(self.train_model.get_weights())
         self._weights_updated = False
 
     def reset_predict_model(self):
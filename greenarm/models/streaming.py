@@ -0,0 +1,198 @@
+"""
+Online scoring of continuous telemetry with the stateful STORN predict model.
+"""
+import numpy as np
+
+import keras.backend as K
+from greenarm.util import get_logger
+
+logger = get_logger(__name__)
+
+
+def _stateful_states(model):
+    return [state for layer in model.layers if getattr(layer, "stateful", False) for state in layer.states]
+
+
+def get_state_rows(model, rows):
+    """
+    Reads the recurrent states of some batch rows of a stateful model.
+
+    :param model: a keras model with stateful recurrent layers
+    :param rows: the batch rows to read
+    :return: a list with one array per state variable
+    """
+    return [value[rows] for value in K.batch_get_value(_stateful_states(model))]
+
+
+def set_state_rows(model, rows, values):
+    """
+    Overwrites the recurrent states of some batch rows of a stateful model,
+    the other rows keep their states.
+
+    :param model: a keras model with stateful recurrent layers
+    :param rows: the batch rows to write
+    :param values: a list with one array per state variable, as returned by get_state_rows
+    """
+    states = _stateful_states(model)
+    current = K.batch_get_value(states)
+    for value, new_value in zip(current, values):
+        value[rows] = new_value
+    K.batch_set_value(list(zip(states, current)))
+
+
+def reset_state_rows(model, rows):
+    """
+    Resets the recurrent states of some batch rows of a stateful model to zero.
+    """
+    states = _stateful_states(model)
+    current = K.batch_get_value(states)
+    for value in current:
+        value[rows] = 0.
+    K.batch_set_value(list(zip(states, current)))
+
+
+class STORNStreamScorer(object):
+    """
+    Keeps the LSTM states of the STORN predict model alive between calls and
+    scores one time step of every stream per call, so the prefix of a sequence
+    never has to be fed through the network again.
+    """
+
+    def __init__(self, storn_model):
+        if storn_model.predict_model is None:
+            raise ValueError("The STORN model has no predict model! Call build() or from_files() first.")
+
+        self.storn_model = storn_model
+        self.data_dim = storn_model.data_dim
+        self.latent_dim = storn_model.latent_dim
+        self.batch_size = storn_model.predict_model.input_shape[0][0]
+
+        # Buffers fed to the predict model, the rows of the batch are the streams
+        self.x_t = np.zeros((self.batch_size, 1, self.data_dim), dtype="float32")
+        self.x_tm1 = np.zeros((self.batch_size, 1, self.data_dim), dtype="float32")
+        self.prior_input = None
+        if storn_model.feeds_prior_input:
+            self.prior_input = storn_model.standard_prior_input(self.batch_size, 1)
+        self._get_loss = storn_model.get_loss_function()
+
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the recurrent states and the previous samples of all streams.
+        """
+        self.storn_model.reset_predict_model()
+        self.x_tm1[:] = 0.
+
+    def reset_rows(self, rows):
+        """
+        Resets the recurrent states and the previous samples of some streams only.
+
+        :param rows: the batch rows of the streams to reset
+        """
+        reset_state_rows(self.storn_model.predict_model, rows)
+        self.x_tm1[rows] = 0.
+
+    def step(self, x_t):
+        """
+        Scores a single time step.
+
+        :param x_t: the current sample of every stream, shape (n_streams, data_dim)
+                    with n_streams <= the batch size of the predict model
+        :return: the variational loss (NLL + KL) of every stream, shape (n_streams,)
+        """
+        n_streams = x_t.shape[0]
+        assert x_t.shape[-1] == self.data_dim, \
+            "Data dimensions do not match! Model is expecting {} features. Input has {}".format(self.data_dim,
+                                                                                                x_t.shape[-1])
+        assert n_streams <= self.batch_size, \
+            "Too many streams! The predict model serves at most {} streams.".format(self.batch_size)
+
+        self.x_t[:n_streams, 0, :] = x_t
+        self.x_t[n_streams:] = 0.
+
+        inputs = [self.x_t, self.x_tm1]
+        if self.prior_input is not None:
+            inputs.append(self.prior_input)
+
+        statistics = self.storn_model.predict_model.predict_on_batch(inputs)
+        loss = self._get_loss([self.x_t, statistics])[0]
+
+        # The current sample is the previous one of the next step
+        self.x_tm1, self.x_t = self.x_t, self.x_tm1
+
+        return loss[:n_streams, 0]
+
+
+class StreamSlotScheduler(object):
+    """
+    Maps independent device streams onto the rows of the fixed size predict batch.
+    Streams may join and leave at any time without touching the states of the others,
+    and free rows are reused, so one forward pass serves up to batch_size live streams.
+    """
+
+    def __init__(self, scorer):
+        self.scorer = scorer
+        self.batch_size = scorer.batch_size
+
+        # Object state
+        self.slots = {}
+        self.free_rows = list(range(self.batch_size))
+
+    def join(self, stream_id):
+        """
+        Assigns the lowest free batch row to a new stream and resets its state.
+
+        :param stream_id: any hashable identifier of the stream
+        :return: the batch row of the stream
+        """
+        if stream_id in self.slots:
+            raise ValueError("Stream {} already joined!".format(stream_id))
+        if not self.free_rows:
+            raise ValueError("All {} slots are taken!".format(self.batch_size))
+
+        row = min(self.free_rows)
+        self.free_rows.remove(row)
+        self.scorer.reset_rows([row])
+        self.slots[stream_id] = row
+        logger.debug("Stream %s joined on row %d" % (stream_id, row))
+        return row
+
+    def leave(self, stream_id):
+        """
+        Releases the batch row of a stream.
+        """
+        row = self.slots.pop(stream_id)
+        self.free_rows.append(row)
+        logger.debug("Stream %s left row %d" % (stream_id, row))
+
+    def step(self, samples):
+        """
+        Scores one time step for the given streams. Streams that are joined but
+        have no sample in this step keep their state.
+
+        :param samples: a dict mapping stream ids to samples of shape (data_dim,)
+        :return: a dict mapping stream ids to the variational loss of the step
+        """
+        for stream_id in samples:
+            if stream_id not in self.slots:
+                self.join(stream_id)
+
+        x_t = np.zeros((self.batch_size, self.scorer.data_dim), dtype="float32")
+        for stream_id, sample in samples.items():
+            x_t[self.slots[stream_id]] = sample
+
+        # Rows of waiting streams must not be advanced by the forward pass
+        held = [row for stream_id, row in self.slots.items() if stream_id not in samples]
+        if held:
+            model = self.scorer.storn_model.predict_model
+            held_states = get_state_rows(model, held)
+            held_x_tm1 = self.scorer.x_tm1[held].copy()
+
+        loss = self.scorer.step(x_t)
+
+        if held:
+            set_state_rows(model, held, held_states)
+            self.scorer.x_tm1[held] = held_x_tm1
+
+        return {stream_id: loss[self.slots[stream_id]] for stream_id in samples}
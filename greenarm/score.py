@@ -0,0 +1,152 @@
+"""
+Scores a directory of recordings with a trained STORN model.
+
+Every recording is a .npy array of shape (n_samples, n_features). The files are shared
+out to a pool of worker processes, each loads the model once into its own backend
+session. The recordings are memory-mapped and cut into windows, and the per step loss
+of every file is written to <output_folder>/<name>.loss.npy with shape (n_windows, seq_len).
+
+Usage:
+    greenarm-score parameters.json weights.h5 recordings/ --output-folder losses/ --workers 4
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+
+from greenarm.util import get_logger, iter_batches, shifted_windows
+
+logger = get_logger(__name__)
+
+# The model of the worker processes, loaded once per worker by _init_worker
+_worker_model = None
+# The traceback of a failed model loading, a pool restarts workers whose initializer raises forever
+_worker_error = None
+
+
+def _init_worker(model_file, weights_file):
+    global _worker_model, _worker_error
+    try:
+        # Keras is imported in the workers only, so every process has its own backend session
+        from greenarm.models.STORN import STORNModel
+
+        _worker_model = STORNModel.from_files(model_file, weights_file)
+    except Exception:
+        _worker_error = traceback.format_exc()
+
+
+def _score_file(task):
+    if _worker_error is not None:
+        raise RuntimeError("The worker could not load the model:\n%s" % _worker_error)
+
+    start = time.time()
+    data = np.load(task["input"], mmap_mode="r")[:, task["skip_columns"]:]
+    if data.shape[0] <= task["seq_len"]:
+        logger.warning("Skipping %s, it is shorter than one window" % task["input"])
+        return task["input"], 0, time.time() - start
+
+    x_next, x_prev = shifted_windows(data, task["seq_len"], stride=task["stride"])
+
+    # Partial files of interrupted runs are not taken for finished ones
+    partial_path = task["output"] + ".partial.npy"
+    loss = np.lib.format.open_memmap(partial_path, mode="w+", dtype="float32", shape=x_next.shape[:2])
+    for first, last, (x_t, x_tm1) in iter_batches([x_next, x_prev], task["batch_windows"]):
+        x_t = np.asarray(x_t, dtype="float32")
+        _, batch_loss = _worker_model.evaluate_offline([x_t, np.asarray(x_tm1, dtype="float32")], x_t)
+        loss[first:last] = batch_loss[0]
+    loss.flush()
+    del loss
+    os.rename(partial_path, task["output"])
+
+    return task["input"], x_next.shape[0], time.time() - start
+
+
+def score_files(model_file, weights_file, input_files, output_folder, seq_len, stride=None, skip_columns=0,
+                batch_windows=1024, workers=None, overwrite=False):
+    """
+    Scores the recordings in a pool of worker processes.
+
+    :param input_files: the paths of the .npy recordings, their file names have to be unique
+    :param output_folder: the folder for the .loss.npy files
+    :param seq_len: the sequence length of the windows
+    :param stride: the number of samples between two windows, non-overlapping windows by default
+    :param skip_columns: the number of leading columns that are no features, e.g. timestamps
+    :param batch_windows: the number of windows per evaluation
+    :param workers: the number of worker processes, the number of cores by default
+    :param overwrite: score files that already have an output again
+    """
+    for path in (model_file, weights_file):
+        if not os.path.isfile(path):
+            raise IOError("%s does not exist!" % path)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    tasks = []
+    inputs_by_output = {}
+    for input_file in sorted(set(os.path.abspath(f) for f in input_files)):
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        output = os.path.join(output_folder, name + ".loss.npy")
+        # Two workers would write the same output
+        if output in inputs_by_output:
+            raise ValueError("%s and %s would both be scored to %s!" % (inputs_by_output[output], input_file, output))
+        inputs_by_output[output] = input_file
+        if os.path.exists(output) and not overwrite:
+            logger.info("Skipping %s, %s exists" % (input_file, output))
+            continue
+        tasks.append(dict(input=input_file, output=output, seq_len=seq_len, stride=stride,
+                          skip_columns=skip_columns, batch_windows=batch_windows))
+
+    if not tasks:
+        return
+    workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+    logger.info("Scoring %d files with %d workers" % (len(tasks), workers))
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model_file, weights_file))
+    try:
+        for done, (input_file, n_windows, duration) in enumerate(pool.imap_unordered(_score_file, tasks)):
+            logger.info("%d/%d: scored %d windows of %s in %.1fs" % (done + 1, len(tasks), n_windows, input_file,
+                                                                     duration))
+        pool.close()
+    except BaseException as e:
+        # The remaining files would fail the same way, e.g. if the model cannot be loaded
+        logger.error("Scoring failed: %s" % e)
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scores recordings with a trained STORN model")
+    parser.add_argument("model_file", help="the parameters.json of the model")
+    parser.add_argument("weights_file", help="the weights.h5 of the model")
+    parser.add_argument("inputs", nargs="+", help=".npy recordings or folders of them")
+    parser.add_argument("--output-folder", default="losses")
+    parser.add_argument("--seq-len", type=int, default=100)
+    parser.add_argument("--stride", type=int, default=None)
+    parser.add_argument("--skip-columns", type=int, default=0)
+    parser.add_argument("--batch-windows", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    input_files = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            # Outputs of earlier runs may share the folder
+            input_files.extend(f for f in glob.glob(os.path.join(path, "*.npy"))
+                               if not f.endswith((".loss.npy", ".partial.npy")))
+        else:
+            input_files.append(path)
+
+    score_files(args.model_file, args.weights_file, input_files, args.output_folder, args.seq_len,
+                stride=args.stride, skip_columns=args.skip_columns, batch_windows=args.batch_windows,
+                workers=args.workers, overwrite=args.overwrite)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 import logging
 import numpy as np
 import random
+from numpy.lib.stride_tricks import as_strided
 from sklearn.metrics import roc_curve, auc
+from greenarm.metrics import confusion_counts
 
 logging.basicConfig(format="%(asctime)s %(levelname)-8s %(name)-18s: %(message)s", level=logging.INFO)
 
@@ -17,27 +19,93 @@ def generate_shifted(data, predict_forward=1):
     return data[:, :-predict_forward, :], data[:, predict_forward:, :]
 
 
+def window_view(data, window, stride=1):
+    """
+    Creates overlapping or strided windows over the first axis of an array without copying it.
+
+    :param data: an array of shape (n_samples, ...), e.g. a memory-mapped recording
+    :param window: the number of samples per window
+    :param stride: the number of samples between the starts of two windows
+    :return: a read-only view of shape (n_windows, window, ...)
+    """
+    if window < 1 or stride < 1 or data.shape[0] < window:
+        raise ValueError("Cannot create windows of size {} with stride {} from {} samples!".format(
+            window, stride, data.shape[0]))
+
+    n_windows = (data.shape[0] - window) // stride + 1
+    shape = (n_windows, window) + data.shape[1:]
+    strides = (data.strides[0] * stride,) + data.strides
+    return as_strided(data, shape=shape, strides=strides, writeable=False)
+
+
+def shifted_windows(data, seq_len, stride=None, horizon=1):
+    """
+    Creates both STORN inputs from one underlying array. The windows are views, so
+    neither the next nor the previous samples are copied.
+
+    :param data: an array of shape (n_samples, data_dim), e.g. a memory-mapped recording
+    :param seq_len: the sequence length of the windows
+    :param stride: the number of samples between two windows, non-overlapping windows by default
+    :param horizon: how many steps x_next is ahead of x_prev
+    :return: the views x_next and x_prev of shape (n_windows, seq_len, data_dim)
+    """
+    if horizon < 1:
+        raise ValueError("The horizon has to be at least 1, got {}!".format(horizon))
+
+    windows = window_view(data, seq_len + horizon, stride=seq_len if stride is None else stride)
+    return windows[:, horizon:], windows[:, :-horizon]
+
+
 def add_samples_until_divisible(x, batch_size):
-    num_samples = x.shape[0]
-    sample_shape = x.shape[1:]
-    num_missing = batch_size * (num_samples // batch_size + 1) - num_samples
-    missing_shape = tuple([num_missing] + list(sample_shape))
-    return np.vstack([x, np.zeros(shape=missing_shape)])
+    """
+    Appends zero samples until the number of samples is divisible by the batch size.
+    The dtype is preserved, and x itself is returned if no padding is needed.
+    """
+    num_missing = -x.shape[0] % batch_size
+    if num_missing == 0:
+        return x
+    return np.concatenate([x, np.zeros((num_missing,) + x.shape[1:], dtype=x.dtype)])
+
+
+def iter_batches(arrays, batch_size, pad_last=False):
+    """
+    Iterates over the batches of several arrays with the same number of samples.
+    The batches are views of the arrays, so nothing is copied.
+
+    :param arrays: a list of arrays of shape (n_samples, ...)
+    :param batch_size: the number of samples per batch
+    :param pad_last: zero-pad a smaller last batch to batch_size, as stateful models need
+                     a fixed batch size. Only this batch is copied.
+    :return: a generator of (start, stop, batches), stop - start is the number of real samples
+    """
+    n_samples = arrays[0].shape[0]
+    for start in range(0, n_samples, batch_size):
+        stop = min(start + batch_size, n_samples)
+        batches = [x[start:stop] for x in arrays]
+        if pad_last and stop - start < batch_size:
+            batches = [add_samples_until_divisible(batch, batch_size) for batch in batches]
+        yield start, stop, batches
 
 
 def subsample(sequence, step):
     """
     :param sequence: A sequence to be sub-sampled. The original sampling period must be at least 2*step.
+                     The timestamps in the first column have to be sorted.
     :param step: The sub-sampling period.
     :return: The sub-sampled result.
     """
-    result = []
-    prev = sequence[0, 0]
-    for i, current_timestamp in enumerate(sequence[:, 0]):
-        if current_timestamp >= (prev + step):
-            result.append(sequence[i, :])
-            prev = current_timestamp
-    return np.asarray(result, dtype='float32')
+    timestamps = sequence[:, 0]
+    n_samples = timestamps.shape[0]
+
+    # The first sample that is at least one step ahead of every sample
+    next_indices = np.maximum(np.searchsorted(timestamps, timestamps + step), np.arange(1, n_samples + 1)).tolist()
+
+    indices = []
+    i = int(np.searchsorted(timestamps, timestamps[0] + step))
+    while i < n_samples:
+        indices.append(i)
+        i = next_indices[i]
+    return np.asarray(sequence[indices], dtype='float32')
 
 
 def shuffle_together(*arrays):
@@ -47,21 +115,13 @@ def shuffle_together(*arrays):
 
 
 def print_eval(predicted, ground_truth):
-    tp, fp, tn, fn = 0.000000001, 0.000000001, 0.000000001, 0.000000001
+    predicted = np.asarray(predicted).ravel()
+    ground_truth = np.asarray(ground_truth).ravel()
     total = predicted.shape[0]
-    corrects = 0.
-    for p, gt in zip(predicted, ground_truth):
-        if p == gt:
-            corrects += 1.
-            if gt:
-                tp += 1.
-            else:
-                tn += 1.
-        else:
-            if gt:
-                fn += 1.
-            else:
-                fp += 1.
+
+    # The counts start slightly above zero, so the ratios are always defined
+    tp, fp, tn, fn = [count + 0.000000001 for count in confusion_counts(predicted, ground_truth)]
+    corrects = np.count_nonzero(predicted == ground_truth)
 
     logger.info("Total: %s. Positives: %s. Negatives: %s" % (total, ground_truth.sum(), total - ground_truth.sum()))
     logger.info("Predicted: Positives: %s. Negatives: %s" % (predicted.sum(), total - predicted.sum()))
@@ -86,19 +146,15 @@ def pad_sequences_3d(sequences, maxlen, return_paddings=False, skip_first_n_dims
     data_dimensionality = sequences[0].shape[-1] - skip_first_n_dims
     data = np.zeros(shape=(len(sequences), maxlen, data_dimensionality), dtype="float32")
 
-    paddings = []
-    for sample_index, sample in enumerate(sequences):
-        if maxlen >= sample.shape[0]:
-            data[sample_index] = np.vstack(
-                (np.zeros((maxlen - sample.shape[0], data_dimensionality)), sample[:, skip_first_n_dims:])
-            )
-            paddings.append(maxlen - sample.shape[0])
-        else:
-            data[sample_index] = sample[:maxlen, skip_first_n_dims:]
-            paddings.append(0)
+    # Sequences are pre-padded with zeros and truncated after maxlen
+    lengths = np.minimum([sample.shape[0] for sample in sequences], maxlen)
+    paddings = maxlen - lengths
+
+    for sample_index, (sample, length, padding) in enumerate(zip(sequences, lengths.tolist(), paddings.tolist())):
+        data[sample_index, padding:] = sample[:length, skip_first_n_dims:]
 
     if return_paddings:
-        return data, paddings
+        return data, paddings.tolist()
 
     return data
 
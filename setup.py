@@ -38,7 +38,7 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     keywords='storn keras anomaly detection',  # Optional
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),  # Required
+    packages=find_packages(exclude=['contrib', 'docs', 'tests', 'benchmarks', 'benchmarks.*']),  # Required
     python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, <4',
     install_requires=[
         'keras',
@@ -50,6 +50,9 @@ setup(
         'dev': ['check-manifest'],
         'test': ['coverage'],
     },
+    entry_points={
+        'console_scripts': ['greenarm-score=greenarm.score:main'],
+    },
     project_urls={  # Optional
         'Paper': 'https://arxiv.org/abs/1602.07109',
         'Additional': 'http://www.diva-portal.org/smash/get/diva2:896301/FULLTEXT01.pdf',